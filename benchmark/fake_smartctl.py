@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Stand-in for smartctl that replays recorded outputs from benchmark/fixtures.
+# Point BIN_PATH at this file. Environment:
+#   FAKE_SMARTCTL_DISKS=N       scan reports N synthetic disks cycling through fixtures, 0 lists each fixture once
+#   FAKE_SMARTCTL_DELAY=0.05    seconds added to every disk query
+#   FAKE_SMARTCTL_STANDBY=1     all disks are asleep, '-n standby' queries do not get values
+#   FAKE_SMARTCTL_SLOTS=0,3     occupied slots of any RAID controller ('-d type,N'), they answer as megaraid fixture
+#   FAKE_SMARTCTL_TESTING=/dev/sda,/dev/disk3   disks with a self-test in progress, 90% remaining. '-t' is accepted by any
+#   FAKE_SMARTCTL_VERSION=7.2   reported by -V
+#   FAKE_SMARTCTL_FIXTURES=dir  where fixtures are read from
+
+import os
+import re
+import json
+import sys
+import time
+
+FIXTURES_DIR = os.environ.get('FAKE_SMARTCTL_FIXTURES',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+
+# device as reported by --scan, fixture name
+FIXTURE_DEVICES = (
+    ('/dev/sda -d scsi',         'sata'),
+    ('/dev/sdb -d scsi',         'sas'),
+    ('/dev/nvme0 -d nvme',       'nvme'),
+    ('/dev/bus/0 -d megaraid,0', 'megaraid'),
+    ('/dev/csmi0,1 -d ata',      'csmi'),
+    ('/dev/sdc -d scsi',         'usb_bridge'),
+)
+
+# smartctl exit status recorded with the fixture
+EXIT_CODES = {
+    'megaraid':   64,   # error log has entries
+    'usb_bridge': 1,    # command line did not parse
+}
+
+# absent without '-a' or '-i'
+IDENTITY_KEYS = ('model_family', 'model_name', 'serial_number', 'wwn', 'firmware_version', 'user_capacity',
+                 'rotation_rate', 'form_factor', 'sata_version', 'interface_speed', 'smart_support',
+                 'scsi_vendor', 'scsi_product', 'scsi_revision', 'scsi_version', 'logical_unit_id')
+
+SERIAL_RE = re.compile(r'((?:Serial [Nn]umber:\s+)|(?:"serial_number": "))([^\s"]+)')
+
+
+def findSyntheticCount():
+
+    return int(os.environ.get('FAKE_SMARTCTL_DISKS', '0'))
+
+
+def printScan():
+
+    count = findSyntheticCount()
+    if count:
+        for i in range(count):
+            print('/dev/disk%s -d scsi # /dev/disk%s, SCSI device' % (i, i))
+    else:
+        for device, name in FIXTURE_DEVICES:
+            print('%s # %s, %s' % (device, device.split()[0], name))
+
+
+def stripIdentity(out_, isJson_):
+    '''Output of '-H -A': no information section.'''
+    if isJson_:
+        doc = json.loads(out_)
+        for i in IDENTITY_KEYS:
+            doc.pop(i, None)
+        return json.dumps(doc, indent=2) + '\n'
+
+    return re.sub(r'=== START OF INFORMATION SECTION ===\n.*?\n\n', '', out_, flags=re.S)
+
+
+def findFixture(args_):
+    '''Fixture name and synthetic disk index (None for fixture devices).'''
+    args = ' '.join(args_)
+
+    slotRe = re.search(r'\s-d\s+[\w+]+,(\d+)', args)
+    if slotRe:
+        slot = int(slotRe.group(1))
+        if str(slot) not in os.environ.get('FAKE_SMARTCTL_SLOTS', '0').split(','):
+            return None, None
+        return 'megaraid', slot or None   # slot 0 is the recorded disk
+
+    syntheticRe = re.search(r'/dev/disk(\d+)', args)
+    if syntheticRe:
+        index = int(syntheticRe.group(1))
+        return FIXTURE_DEVICES[index % len(FIXTURE_DEVICES)][1], index
+
+    for device, name in FIXTURE_DEVICES:
+        path = device.split()[0]
+        if re.search(r'(^|\s)%s(\s|$)' % re.escape(path), args):
+            return name, None
+
+    return None, None
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+
+    if '-V' in args:
+        print('smartctl %s 2020-12-30 r5155 [x86_64-linux-5.10.0-21-amd64] (local build)' %
+              os.environ.get('FAKE_SMARTCTL_VERSION', '7.2'))
+        sys.exit(0)
+
+    if '--scan' in args:
+        if 'nvme' not in args:
+            printScan()
+        sys.exit(0)
+
+    name, index = findFixture(args)
+    if not name:
+        print('Smartctl open device: %s failed: No such device' % args[-1])
+        sys.exit(2)
+
+    time.sleep(float(os.environ.get('FAKE_SMARTCTL_DELAY', '0')))
+
+    if '-n' in args and os.environ.get('FAKE_SMARTCTL_STANDBY') == '1':
+        if '-j' in args:
+            print('{"smartctl": {"version": [7, 2], "messages": [{"string": "Device is in STANDBY mode, exit(2)", '
+                  '"severity": "information"}], "exit_status": 2}}')
+        else:
+            print('Device is in STANDBY mode, exit(2)')
+        sys.exit(2)
+
+    if '-t' in args:
+        print('=== START OF OFFLINE IMMEDIATE AND SELF-TEST SECTION ===\nTesting has begun.')
+        sys.exit(0)
+
+    ext = '-j' in args and '.json' or '.txt'
+    with open(os.path.join(FIXTURES_DIR, name + ext)) as f:
+        out = f.read()
+
+    if '-a' not in args and '-i' not in args:
+        out = stripIdentity(out, '-j' in args)
+
+    device = [ i for i in args if i.startswith('/dev/') ][:1]
+    if device and device[0] in os.environ.get('FAKE_SMARTCTL_TESTING', '').split(','):
+        out = re.sub(r'(Self-test execution status:\s+\()\s*0\)', r'\g<1> 249)', out)
+        out = re.sub(r'("self_test": \{\s+"status": \{\s+"value": )0', r'\g<1>249', out)
+
+    if index is not None:   # unique serials, otherwise synthetic disks are skipped as duplicates
+        out = SERIAL_RE.sub(lambda m: '%s%sS%04d' % (m.group(1), m.group(2), index), out)
+
+    sys.stdout.write(out)
+    sys.exit(EXIT_CODES.get(name, 0))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Compare sender lines and LLD json for the fixture host against benchmark/golden/<engine>.txt.
+#
+#   python3 benchmark/golden.py           check both engines, exit code 1 on difference
+#   python3 benchmark/golden.py update    rewrite golden files after an intended output change
+
+import os
+import re
+import sys
+import difflib
+from json import dumps
+
+from harness import GOLDEN_DIR, loadCollector, useFakeSmartctl, runCollector
+
+TIMING_RE = re.compile(r'^(.+Time\]) ".*"$')   # differ on every run
+
+
+def renderOutput(collector_, engine_):
+
+    useFakeSmartctl(collector_, engine_)
+    senderLines, jsonData = runCollector(collector_)
+
+    senderLines = [ TIMING_RE.sub(r'\1 "-"', i) for i in senderLines ]
+
+    return senderLines + [ dumps(i, sort_keys=True) for i in jsonData ]
+
+
+if __name__ == '__main__':
+
+    isUpdate = len(sys.argv) > 1 and sys.argv[1] == 'update'
+
+    collector = loadCollector()
+
+    failed = False
+    for engine in ('text', 'json'):
+        lines = renderOutput(collector, engine)
+        goldenPath = os.path.join(GOLDEN_DIR, engine + '.txt')
+
+        if isUpdate:
+            if not os.path.isdir(GOLDEN_DIR):
+                os.makedirs(GOLDEN_DIR)
+            with open(goldenPath, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            print('%s: %s lines written' % (engine, len(lines)))
+            continue
+
+        with open(goldenPath) as f:
+            golden = f.read().splitlines()
+
+        diff = list(difflib.unified_diff(golden, lines, goldenPath, 'current', lineterm=''))
+        if diff:
+            failed = True
+            print('\n'.join(diff))
+        else:
+            print('%s: %s lines match' % (engine, len(lines)))
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,52 @@
+# Shared helpers for the benchmark scripts: load smartctl-lld.py as a module and run it against fake_smartctl.py.
+
+import os
+import sys
+import tempfile
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCH_DIR, '..', 'scripts')
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+GOLDEN_DIR = os.path.join(BENCH_DIR, 'golden')
+FAKE_SMARTCTL_PATH = os.path.join(BENCH_DIR, 'fake_smartctl.py')
+
+
+def loadCollector():
+    '''Import smartctl-lld.py as a module. It reads HOST from argv.'''
+    sys.path.insert(0, SCRIPTS_DIR)
+    sys.argv = [sys.argv[0], 'get', 'bench']
+    spec = importlib.util.spec_from_file_location('smartctl_lld', os.path.join(SCRIPTS_DIR, 'smartctl-lld.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def listFixtures(ext_):
+
+    return sorted([ i[:-len(ext_)] for i in os.listdir(FIXTURES_DIR) if i.endswith(ext_) ])
+
+
+def readFixture(name_):
+
+    with open(os.path.join(FIXTURES_DIR, name_)) as f:
+        return f.read()
+
+
+def useFakeSmartctl(collector_, engine_):
+    '''Point the collector at fake_smartctl.py, without sudo and with a throwaway state dir.'''
+    collector_.BIN_PATH = FAKE_SMARTCTL_PATH
+    collector_.addSudoIfNix = lambda cmd: cmd
+    collector_.ENGINE = engine_
+    collector_.SCAN_CACHE_TTL = 0
+    collector_.STATE_DIR = tempfile.mkdtemp(prefix='smartctl-bench-')
+
+
+def runCollector(collector_, disks_=0):
+    '''One full collection against a synthetic host. Returns sender lines and LLD json.'''
+    os.environ['FAKE_SMARTCTL_DISKS'] = str(disks_)
+
+    senderData, jsonData = collector_.collectAll()
+
+    return collector_.formatSenderData(senderData), jsonData
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Parse time per disk: single-pass tokenizer against per-key regex scans it replaced, and JSON output.
+#
+#   python3 benchmark/parse_bench.py [iterations]
+
+import re
+import sys
+import timeit
+
+from harness import loadCollector, listFixtures, readFixture
+
+
+# Previous implementation: one re.findall over the whole output per key
+legacyKeysAndRegexps = (
+    r'^Model Family:\s+(.+)$',
+    r'^Device Model:\s+(.+)$|^Device:\s+(.+)$|^Product:\s+(.+)$|^Model Number:\s+(.+)$',
+    r'^SMART overall-health self-assessment test result:\s+(.+)$|^SMART Health Status:\s+(.+)$',
+    r'^Serial Number:\s+(.+)$',
+    r'^SATA Version is:\s+(.+)$',
+    r'^SATA Version is:\s+.+,\s+(\d+\.\d+)\s+Gb\/s',
+    r'^SATA Version is:\s+.+current\:\s+(\d+\.\d+)\s+Gb\/s|^SATA Version is:\s+.+,\s+(\d+\.\d+)\s+Gb\/s',
+    r'^Rotation Rate:\s+(\d+)\s+rpm$',
+    r'^Form Factor:\s+(.+)$',
+    r'^Firmware Version:\s+(.+)$',
+    r'^Vendor:\s+(.+)$',
+    r'^Percentage used endurance indicator:\s+(\d+)',
+    r'^User Capacity:\s+(.+)bytes',
+    r'^(?:\s+)?(\d+)\s+([\w-]+)\s+[\w-]+\s+\d{3}\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+(\d+)',
+)
+
+legacyKeysAndRegexpsSAS = (
+    r'^Revision:\s+(.+)$|^Version:\s+(.+)$',
+    r'^Compliance:\s+(.+)$',
+    r'^Manufactured in week \d+ of year (\d+)',
+    r'^Accumulated load-unload cycles:\s+(\d+)',
+    r'^Specified load-unload count over device lifetime:\s+(\d+)',
+    r'^Accumulated start-stop cycles:\s+(\d+)|^Current start stop count:\s+(\d+)',
+    r'^Recommended maximum start stop count:\s+(\d+)|^Specified cycle count over device lifetime:\s+(\d+)',
+    r'^Elements in grown defect list:\s+(\d+)',
+    r'^number of hours powered up \=\s+(\d+)',
+    r'^Non-medium error count:\s+(\d+)',
+)
+
+legacyIdentAndWhy = (
+    r'^Serial Number:\s+(.+)$',
+    r'^SMART support is:\s+Unavailable - device lacks SMART capability',
+    r'^SMART support is:\s+Unavailable - Packet Interface Devices',
+    r'^SMART support is:\s+Disabled',
+    r'Unknown USB bridge',
+)
+
+
+def legacyParse(p_):
+    '''Regex passes only, without composing sender lines.'''
+    for regexp in legacyKeysAndRegexps:
+        re.findall(regexp, p_, re.M | re.I)
+
+    for regexp in legacyKeysAndRegexpsSAS:
+        re.findall(regexp, p_, re.M | re.I)
+
+    for regexp in legacyIdentAndWhy:
+        re.search(regexp, p_, re.M | re.I)
+
+
+def currentParse(collector_, p_, isJson_=False):
+
+    parsed = collector_.parseOutput(p_, isJson_)
+    ident = collector_.findIdent(parsed, 'sda')
+    collector_.sanitizeStr(collector_.clearDiskTypeStr('/dev/sda -d sat+megaraid,4'))
+    collector_.findSmart(parsed, ident)
+    collector_.findSmartSAS(parsed, ident)
+    collector_.whyNoSmart(parsed)
+
+
+if __name__ == '__main__':
+
+    iterations = 2000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    collector = loadCollector()
+
+    print('%-12s %12s %14s %8s %10s' % ('fixture', 'regex, us', 'tokenizer, us', 'speedup', 'json, us'))
+    for name in listFixtures('.txt'):
+        p = readFixture(name + '.txt')
+
+        legacy  = timeit.timeit(lambda: legacyParse(p), number=iterations) / iterations * 1e6
+        current = timeit.timeit(lambda: currentParse(collector, p), number=iterations) / iterations * 1e6
+
+        json = '-'
+        if name in listFixtures('.json'):
+            doc = readFixture(name + '.json')
+            json = '%.1f' % (timeit.timeit(lambda: currentParse(collector, doc, True), number=iterations) / iterations * 1e6)
+
+        print('%-12s %12.1f %14.1f %7.1fx %10s' % (name, legacy, current, legacy / current, json))
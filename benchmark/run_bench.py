@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# Full-run wall time against synthetic hosts served by fake_smartctl.py.
+#
+#   python3 benchmark/run_bench.py [engine] [disk counts...]
+#   python3 benchmark/run_bench.py json 10 100 1000
+#
+# FAKE_SMARTCTL_DELAY adds latency to every disk query, MAX_WORKERS and the rest are read from smartctl-lld.py.
+
+import sys
+import time
+
+from harness import loadCollector, useFakeSmartctl, runCollector
+
+if __name__ == '__main__':
+
+    engine = 'text'
+    if len(sys.argv) > 1:
+        engine = sys.argv[1]
+
+    diskCounts = [ int(i) for i in sys.argv[2:] ] or [10, 100, 1000]
+
+    collector = loadCollector()
+    useFakeSmartctl(collector, engine)
+
+    print('%-6s %6s %10s %12s %8s' % ('engine', 'disks', 'wall, s', 'per disk, ms', 'lines'))
+    for disks in diskCounts:
+        start = time.time()
+        senderLines, jsonData = runCollector(collector, disks)
+        wall = time.time() - start
+
+        print('%-6s %6s %10.2f %12.1f %8s' % (engine, disks, wall, wall / disks * 1e3, len(senderLines)))
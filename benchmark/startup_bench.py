@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Startup cost of an agent call: interpreter, loading smartctl-lld.py, and handing items to the sender.
+#
+#   python3 benchmark/startup_bench.py [runs]
+
+import os
+import sys
+import time
+import subprocess
+
+from harness import SCRIPTS_DIR, loadCollector
+
+LOAD_COLLECTOR = '''
+import sys
+sys.path.insert(0, %r)
+sys.argv = [sys.argv[0], 'get', 'bench']
+import importlib.util
+spec = importlib.util.spec_from_file_location('smartctl_lld', %r)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+''' % (SCRIPTS_DIR, os.path.join(SCRIPTS_DIR, 'smartctl-lld.py'))
+
+
+def median(values_):
+
+    values = sorted(values_)
+    return values[len(values) // 2]
+
+
+def timeCommand(cmd_, runs_):
+    '''Median wall time of a command, ms.'''
+    times = []
+    for i in range(runs_):
+        started = time.time()
+        subprocess.call(cmd_, stdin=subprocess.DEVNULL)
+        times.append(time.time() - started)
+
+    return median(times) * 1000
+
+
+def timeSender(collector_, isFork_, runs_):
+    '''Median time until items can be written to the sender and the sender is done with empty input, ms.'''
+    times = []
+    for i in range(runs_):
+        started = time.time()
+        sender = collector_.openSender('/dev/null', os.path.join(SCRIPTS_DIR, 'sender_wrapper.py'), 'native', '0',
+                                       'bench', isFork_=isFork_)
+        sender.stdin.close()
+        if isFork_:
+            os.waitpid(sender.pid, 0)
+        else:
+            sender.wait()
+        times.append(time.time() - started)
+
+    return median(times) * 1000
+
+
+if __name__ == '__main__':
+
+    runs = 20
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    collector = loadCollector()
+
+    print('%-28s %8s' % ('stage', 'ms'))
+    print('%-28s %8.1f' % ('interpreter', timeCommand([sys.executable, '-c', 'pass'], runs)))
+    print('%-28s %8.1f' % ('interpreter + collector', timeCommand([sys.executable, '-c', LOAD_COLLECTOR], runs)))
+    print('%-28s %8.1f' % ('sender, second interpreter', timeSender(collector, False, runs)))
+    if hasattr(os, 'fork'):
+        print('%-28s %8.1f' % ('sender, forked child', timeSender(collector, True, runs)))
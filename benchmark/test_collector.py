@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Collector edge cases against fake_smartctl.py that the golden files do not cover.
+#
+#   python3 -m unittest discover benchmark
+
+import io
+import os
+import sys
+import unittest
+
+from harness import loadCollector, useFakeSmartctl
+
+FAKE_ENV = ('FAKE_SMARTCTL_DISKS', 'FAKE_SMARTCTL_DELAY', 'FAKE_SMARTCTL_STANDBY', 'FAKE_SMARTCTL_SLOTS',
+            'FAKE_SMARTCTL_TESTING')
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.environ = dict([ (i, os.environ.get(i)) for i in FAKE_ENV ])
+        self.collector = loadCollector()   # fresh module, configuration is per test
+        useFakeSmartctl(self.collector, 'text')
+
+    def tearDown(self):
+
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def findValues(self):
+
+        return dict(self.collector.collectAll()[0])
+
+    def test_run_deadline_is_not_a_disk_timeout(self):
+
+        c = self.collector
+        os.environ['FAKE_SMARTCTL_DELAY'] = '3'
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi']
+        c.RUN_TIMEOUT = 1
+        c.BREAKER_THRESHOLD = 1
+
+        for i in range(2):
+            self.assertEqual(self.findValues()['smartctl.info[sda,DriveStatus]'], 'DISKFATAL_RUN_TIMEOUT')
+
+        self.assertEqual(c.loadState('latency').get('/dev/sda -d scsi', {}).get('timeouts', 0), 0)
+
+    def test_disk_timeout_opens_breaker(self):
+
+        c = self.collector
+        os.environ['FAKE_SMARTCTL_DELAY'] = '3'
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi']
+        c.PER_DISK_TIMEOUT = 1
+        c.BREAKER_THRESHOLD = 1
+
+        self.assertEqual(self.findValues()['smartctl.info[sda,DriveStatus]'], 'DISKFATAL_TIMEOUT')
+        self.assertEqual(self.findValues()['smartctl.info[sda,DriveStatus]'], 'DISKFATAL_BREAKER_OPEN')
+
+    def recordQueries(self):
+        '''smartctl options of every disk query, in order.'''
+        c = self.collector
+        queries = []
+        runSmartctl = c.runSmartctl
+        def recording(args_, timeout_=None):
+            if '-V' not in args_ and '--scan' not in args_:
+                queries.append(' '.join([ i for i in args_ if i.startswith('-') and i not in ('-d', '-j') ]))
+            return runSmartctl(args_, timeout_)
+        c.runSmartctl = recording
+
+        return queries
+
+    def test_hotplug_forces_full_read(self):
+
+        c = self.collector
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi']
+        c.FULL_POLL_INTERVAL = 3600
+        queries = self.recordQueries()
+
+        c.findHotplugStamp = lambda: [1]
+        self.findValues()
+        self.findValues()
+        c.findHotplugStamp = lambda: [2]   # disk swapped at the same path
+        self.findValues()
+
+        self.assertEqual(queries, ['-a', '-H -A', '-a'])
+
+    def test_hotplug_wakes_sleeping_disk(self):
+
+        c = self.collector
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi']
+        c.IS_STANDBY_CHECK = True
+        queries = self.recordQueries()
+
+        c.findHotplugStamp = lambda: [1]
+        self.findValues()
+        os.environ['FAKE_SMARTCTL_STANDBY'] = '1'
+        self.assertEqual(self.findValues()['smartctl.info[sda,powerMode]'], 'STANDBY')
+        c.findHotplugStamp = lambda: [2]   # disk swapped at the same path
+        self.assertEqual(self.findValues()['smartctl.info[sda,powerMode]'], 'ACTIVE')
+
+        self.assertEqual(queries, ['-a', '-a -n', '-a'])
+
+    def test_serial_duplicates_keep_status(self):
+
+        c = self.collector
+        c.MODE = 'serial'
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi', '/dev/sda -d sat', '/dev/sda -d auto']   # three paths, one serial
+
+        for i in range(2):   # duplicates found after querying, then aliases known from the first run
+            senderData, jsonData = c.collectAll()
+            statuses = [ i for i in senderData if i[0] == 'smartctl.info[ZGY5ABCD,DriveStatus]' ]
+            self.assertEqual(statuses, [('smartctl.info[ZGY5ABCD,DriveStatus]', 'PROCESSED')])
+
+            document = c.findDocument(senderData, jsonData)
+            self.assertEqual(document['values']['smartctl.info[ZGY5ABCD,DriveStatus]'], 'PROCESSED')
+            self.assertEqual([ i for i in document['data'] if '{#DDRIVESTATUS}' in i ], [{'{#DDRIVESTATUS}': 'ZGY5ABCD'}])
+
+    def test_textfile_has_no_repeated_series(self):
+
+        c = self.collector
+        c.MODE = 'serial'
+        c.DISK_DEVS_MANUAL = ['/dev/sda -d scsi', '/dev/sda -d sat', '/dev/sda -d auto']   # three paths, one serial
+
+        for i in range(2):
+            samples = [ i for i in c.formatTextfile(*c.collectAll()).splitlines() if not i.startswith('#') ]
+            self.assertEqual(len(samples), len(set([ i.rsplit(' ', 1)[0] for i in samples ])))
+            self.assertIn('smartctl_info_text{disk="ZGY5ABCD",item="DriveStatus",value="PROCESSED"} 1', samples)
+
+        senderData = [('smartctl.info[sda,DriveStatus]', 'PROCESSED'), ('smartctl.info[sda,DriveStatus]', 'DUPLICATE'),
+                      ('smartctl.value[sda,5]', '0'), ('smartctl.value[sda,5]', '8')]
+        self.assertEqual(c.formatTextfile(senderData, []).splitlines()[1::2],
+                         ['smartctl_info_text{disk="sda",item="DriveStatus",value="PROCESSED"} 1',
+                          'smartctl_value{disk="sda",item="5"} 0'])
+
+    def test_lld_hash_is_saved_once_printed(self):
+
+        c = self.collector
+        c.openSender = lambda *args, **kwargs: None
+        chunks = [([], [{'{#DISKID}': 'sda'}])]
+
+        class ClosedStdout(io.StringIO):
+            def write(self, s_):
+                raise BrokenPipeError()
+
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+
+        sys.stdout = ClosedStdout()   # agent timed out
+        self.assertRaises(BrokenPipeError, c.streamData, chunks)
+        sys.stdout = io.StringIO()
+        c.streamData(chunks, isLld_=False)
+        self.assertEqual(c.loadState('lld'), {})
+
+        c.streamData(chunks)
+        self.assertEqual(c.loadState('lld'), {'hash': sys.stdout.getvalue().splitlines()[0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Built-in sender against a fake trapper in a thread: protocol header, compression, server counts, batch halving.
+#
+#   python3 -m unittest discover benchmark
+
+import os
+import sys
+import json
+import zlib
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from harness import SCRIPTS_DIR
+
+sys.path.insert(0, SCRIPTS_DIR)
+import sender_wrapper
+
+
+class FakeTrapper(object):
+    '''Answers every request like Zabbix server, items with keys in failKeys fail. Decoded requests are kept.'''
+
+    def __init__(self, failKeys_=()):
+
+        self.failKeys = set(failKeys_)
+        self.requests = []   # (magic, flags, request)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def recvAll(self, conn_, size_):
+
+        data = b''
+        while len(data) < size_:
+            chunk = conn_.recv(size_ - len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        return data
+
+    def serve(self):
+
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:   # closed
+                return
+
+            header = self.recvAll(conn, 13)
+            flags, length, reserved = struct.unpack('<BII', header[4:])
+            data = self.recvAll(conn, length)
+            if flags & 0x02:
+                data = zlib.decompress(data)
+            request = json.loads(data.decode('utf-8'))
+            self.requests.append((header[:4], flags, request))
+
+            items = request['data']
+            failed = len([ i for i in items if i['key'] in self.failKeys ])
+            body = json.dumps({'response': 'success',
+                               'info': 'processed: %d; failed: %d; total: %d; seconds spent: 0.000100' %
+                                       (len(items) - failed, failed, len(items))}).encode('utf-8')
+            conn.sendall(b'ZBXD' + struct.pack('<BII', 0x01, len(body), 0) + body)
+            conn.close()
+
+    def close(self):
+
+        self.sock.close()
+
+
+class NativeSenderTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.compression = sender_wrapper.IS_NATIVE_COMPRESSION
+        self.confDir = tempfile.mkdtemp(prefix='smartctl-bench-')
+
+    def tearDown(self):
+
+        sender_wrapper.IS_NATIVE_COMPRESSION = self.compression
+
+    def startTrapper(self, failKeys_=()):
+
+        trapper = FakeTrapper(failKeys_)
+        self.addCleanup(trapper.close)
+
+        config = os.path.join(self.confDir, 'zabbix_agentd.conf')
+        with open(config, 'w') as f:
+            f.write('Server=127.0.0.1\nServerActive=127.0.0.1:%s\n' % trapper.port)
+
+        return trapper, config
+
+    def test_request_is_decoded_by_server(self):
+
+        trapper, config = self.startTrapper()
+        lines = ['"host" smartctl.info[sda,model] "ST4000 \\"NAS\\""', '"host" smartctl.value[sda,5] "0"']
+
+        self.assertEqual(sender_wrapper.sendNative(config, '\n'.join(lines)), (2, 0, 0))
+
+        magic, flags, request = trapper.requests[0]
+        self.assertEqual(magic, b'ZBXD')
+        self.assertEqual(flags, 0x01)
+        self.assertEqual(request['request'], 'sender data')
+        self.assertEqual(request['data'], [{'host': 'host', 'key': 'smartctl.info[sda,model]', 'value': 'ST4000 "NAS"'},
+                                           {'host': 'host', 'key': 'smartctl.value[sda,5]', 'value': '0'}])
+
+    def test_compressed_request(self):
+
+        sender_wrapper.IS_NATIVE_COMPRESSION = True
+        trapper, config = self.startTrapper()
+
+        self.assertEqual(sender_wrapper.sendNative(config, '"host" smartctl.value[sda,5] "0"'), (1, 0, 0))
+        self.assertEqual(trapper.requests[0][1], 0x03)
+        self.assertEqual(trapper.requests[0][2]['data'][0]['key'], 'smartctl.value[sda,5]')
+
+    def test_packet_header(self):
+
+        sender_wrapper.IS_NATIVE_COMPRESSION = False
+        packet = sender_wrapper.packZabbix({'request': 'sender data', 'data': []})
+        payload = json.dumps({'request': 'sender data', 'data': []}).encode('utf-8')
+
+        self.assertEqual(packet[:4], b'ZBXD')
+        self.assertEqual(struct.unpack('<BII', packet[4:13]), (0x01, len(payload), 0))
+        self.assertEqual(packet[13:], payload)
+
+    def test_server_counts_and_bad_lines(self):
+
+        trapper, config = self.startTrapper(failKeys_=('smartctl.value[sda,5]',))
+        lines = ['"host" smartctl.value[sda,5] "0"', '"host" smartctl.value[sda,9] "100"', 'not a sender line']
+
+        self.assertEqual(sender_wrapper.sendNative(config, '\n'.join(lines)), (1, 1, 1))
+
+    def test_unreachable_server_fails_all(self):
+
+        trapper, config = self.startTrapper()
+        trapper.close()
+
+        self.assertEqual(sender_wrapper.sendLines(config, 'native', ['"host" k1 "1"', '"host" k2 "2"']), (0, 2))
+
+    def test_failed_batch_is_halved(self):
+
+        trapper, config = self.startTrapper(failKeys_=('k3',))
+        batch = [ '"host" k%d "%d"' % (i, i) for i in range(4) ]
+
+        failedBatches = sender_wrapper.sendBatches(config, 'native', [batch])
+        self.assertEqual(failedBatches, [batch[:2], batch[2:]])
+
+        failedBatches = sender_wrapper.sendBatches(config, 'native', failedBatches)
+        self.assertEqual(failedBatches, [[batch[2]], [batch[3]]])
+
+        failedBatches = sender_wrapper.sendBatches(config, 'native', failedBatches)
+        self.assertEqual(failedBatches, [[batch[3]]])   # single item is kept as it is
+        self.assertEqual([ len(i[2]['data']) for i in trapper.requests ], [4, 2, 2, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
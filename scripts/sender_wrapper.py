@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import subprocess
 import re
-from time import sleep
-from json import dumps
+from time import sleep, time
+from json import dumps, loads
+from collections import namedtuple
+
+SEND_BATCH_SIZE = 250           # items per request, same as zabbix_sender
+RETRY_DELAY = 5                 # first pause before resending failed items, doubled on every retry
+IS_NATIVE_COMPRESSION = False   # compress requests of the built-in sender. Zabbix 4.0 or above required
+NATIVE_TIMEOUT = 30
+
+DEADLINE_RE = re.compile(r'^deadline\s+(\d+)$')   # optional last input line, shortens resending time
 
 
 def isWindows():
@@ -14,26 +23,355 @@ def isWindows():
         return False
 
         
+def findConfigValue(config, name):
+    '''Value of the first uncommented 'name=value' line in agent config, or None.'''
+    try:
+        with open(config, 'r') as f:
+            text = f.read()
+    except (IOError, OSError):
+        return None
+
+    valueRe = re.search(r'^(?:\s+)?%s(?:\s+)?\=(?:\s+)?(.+?)(?:\s+)?$' % name, text, re.M)
+    if valueRe:
+        return valueRe.group(1)
+
+    return None
+
+
+def findServerActive(config):
+    '''First address from 'ServerActive' as (host, port).'''
+    serverActive = findConfigValue(config, 'ServerActive')
+    if not serverActive:
+        return None
+
+    server = serverActive.split(',')[0].strip()
+    port = 10051
+
+    ipv6Re = re.match(r'^\[(.+)\](?::(\d+))?$', server)
+    if ipv6Re:
+        server = ipv6Re.group(1)
+        if ipv6Re.group(2):
+            port = int(ipv6Re.group(2))
+    elif server.count(':') == 1:
+        server, port = server.split(':')
+        port = int(port)
+
+    return server, port
+
+
+def parseSenderLine(line):
+    '''Split zabbix_sender input line '"host" key "value"' into its fields.'''
+    fields = []
+    field = ''
+    isQuoted = False
+    isEscaped = False
+    isField = False
+
+    for char in line.strip():
+        if isEscaped:
+            if char not in ('"', '\\'):
+                field += '\\'
+            field += char
+            isEscaped = False
+        elif isQuoted and char == '\\':
+            isEscaped = True
+        elif char == '"':
+            isQuoted = not isQuoted
+            isField = True
+        elif char.isspace() and not isQuoted:
+            if isField:
+                fields.append(field)
+                field = ''
+                isField = False
+        else:
+            field += char
+            isField = True
+
+    if isField:
+        fields.append(field)
+
+    return fields
+
+
+# socket, struct and zlib of the built-in sender are imported where used, smartctl-lld.py does not need them
+
+def packZabbix(data):
+    '''Zabbix protocol packet: header, flags, data length, reserved (uncompressed length).'''
+    import struct
+    import zlib
+
+    payload = dumps(data).encode('utf-8')
+
+    if IS_NATIVE_COMPRESSION:
+        compressed = zlib.compress(payload)
+        return b'ZBXD' + struct.pack('<BII', 0x03, len(compressed), len(payload)) + compressed
+
+    return b'ZBXD' + struct.pack('<BII', 0x01, len(payload), 0) + payload
+
+
+def recvAll(sock, size):
+    import socket
+
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('Connection closed by server')
+        data += chunk
+
+    return data
+
+
+def unpackZabbix(sock):
+    import socket
+    import struct
+    import zlib
+
+    header = recvAll(sock, 13)
+    if header[:4] != b'ZBXD':
+        raise socket.error('Not a Zabbix protocol response')
+
+    flags, length, reserved = struct.unpack('<BII', header[4:])
+    data = recvAll(sock, length)
+    if flags & 0x02:
+        data = zlib.decompress(data)
+
+    return loads(data.decode('utf-8'))
+
+
+def sendBatchNative(server, items):
+    '''Send one batch of items. Returns (processed, failed, total, info).'''
+    import socket
+
+    request = {'request': 'sender data', 'data': items}
+
+    sock = socket.create_connection(server, NATIVE_TIMEOUT)
+    try:
+        sock.sendall(packZabbix(request))
+        response = unpackZabbix(sock)
+    finally:
+        sock.close()
+
+    info = str(response.get('info', ''))
+    counts = []
+    for name in ('processed', 'failed', 'total'):
+        countRe = re.search(r'%s:\s+(\d+)' % name, info)
+        counts.append(countRe and int(countRe.group(1)) or 0)
+
+    if response.get('response') != 'success':
+        counts = [0, len(items), len(items)]
+
+    return counts[0], counts[1], counts[2], info
+
+
+def parseSenderLines(lines):
+    '''Sender items of the built-in sender from zabbix_sender input lines. Returns (items, skipped).'''
+    items = []
+    skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+
+        fields = parseSenderLine(line)
+        if len(fields) != 3:
+            skipped += 1
+            continue
+
+        items.append({'host': fields[0], 'key': fields[1], 'value': fields[2]})
+
+    return items, skipped
+
+
+def sendNative(config, dataStr, isVerbose=False):
+    '''Built-in replacement of 'zabbix_sender -c config -i -'. Returns (processed, failed, skipped).'''
+    import socket
+    import zlib
+
+    server = findServerActive(config)
+    if not server:
+        if isVerbose:
+            print("Could not find 'ServerActive' setting in config!")
+        return 0, 0, 0
+
+    items, skipped = parseSenderLines(dataStr.splitlines())
+
+    processed = 0
+    failed = 0
+    for i in range(0, len(items), SEND_BATCH_SIZE):
+        batch = items[i:i + SEND_BATCH_SIZE]
+        try:
+            batchProcessed, batchFailed, batchTotal, info = sendBatchNative(server, batch)
+        except (socket.error, ValueError, zlib.error) as e:
+            batchProcessed, batchFailed, info = 0, len(batch), str(e)
+
+        processed += batchProcessed
+        failed += batchFailed
+        if isVerbose:
+            print('Response from "%s:%s": "%s"' % (server[0], server[1], info))
+
+    if isVerbose:
+        print('sent: %s; skipped: %s; total: %s' % (len(items), skipped, len(items) + skipped))
+
+    return processed, failed, skipped
+
+
+def sendLines(config, senderPath_, lines):
+    '''Send lines in one go. Returns (processed, failed) as reported by server.'''
+    if senderPath_ == 'native':
+        processed, failed, skipped = sendNative(config, '\n'.join(lines))
+        return processed, failed + skipped
+
+    try:
+        senderProc = subprocess.Popen([senderPath_, '-c', config, '-i', '-'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      universal_newlines=True, close_fds=(not isWindows()))
+        out = senderProc.communicate(input='\n'.join(lines))[0]
+    except OSError:
+        return 0, len(lines)
+
+    countsRe = re.findall(r'processed:\s+(\d+);\s+failed:\s+(\d+)', out)
+    if not countsRe:   # could not reach server
+        return 0, len(lines)
+
+    processed = sum([ int(i[0]) for i in countsRe ])
+    failed = sum([ int(i[1]) for i in countsRe ])
+
+    return processed, failed
+
+
+def sendTime(config, senderPath_, line, timeKey, seconds):
+    '''Report how long sending took, as an item of the same host as line.'''
+    fields = parseSenderLine(line)
+    if fields:
+        sendLines(config, senderPath_, ['"%s" %s "%.3f"' % (fields[0], timeKey, seconds)])
+
+
+def sendBatches(config, senderPath_, batches):
+    '''Send every batch once. Returns batches with failed items.
+    Server does not tell which items failed, so such batches are halved.'''
+    failedBatches = []
+    for batch in batches:
+        processed, failed = sendLines(config, senderPath_, batch)
+        if not failed:
+            continue
+
+        if failed >= len(batch) or len(batch) == 1:
+            failedBatches.append(batch)
+        else:
+            half = len(batch) // 2
+            failedBatches.extend([batch[:half], batch[half:]])
+
+    return failedBatches
+
+
+def readBatches(lines, deadlines):
+    '''Batches of SEND_BATCH_SIZE lines, each as soon as it is full, so sending starts before input ends.
+    'deadline N' line is put to deadlines instead.'''
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        deadlineRe = DEADLINE_RE.match(line)
+        if deadlineRe:
+            deadlines.append(int(deadlineRe.group(1)))
+            continue
+
+        batch.append(line)
+        if len(batch) >= SEND_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def readAhead(lines):
+    '''Read lines on a thread of its own and yield them from a queue. The writer on the other end of a pipe
+    never waits for sending to a slow server.'''
+    import threading
+    from queue import Queue
+
+    queue = Queue()
+    def readAll():
+        try:
+            for line in lines:
+                queue.put(line)
+        finally:
+            queue.put(None)   # end of input, also if reading has failed
+
+    reader = threading.Thread(target=readAll)
+    reader.daemon = True
+    reader.start()
+
+    while True:
+        line = queue.get()
+        if line is None:
+            return
+        yield line
+
+
+def sendWithRetries(config, senderPath_, lines, deadline, timeKey=None):
+    '''Send lines (any iterable, stdin included) in batches as they come, then resend batches with failed items
+    until deadline (seconds) runs out. Duration of the first attempt is sent to timeKey item if given.'''
+    started = time()
+    deadlines = [deadline]
+
+    firstLine = None
+    pending = []
+    for batch in readBatches(readAhead(lines), deadlines):
+        firstLine = firstLine or batch[0]
+        pending.extend(sendBatches(config, senderPath_, [batch]))
+
+    deadline = min(deadlines)
+
+    retryDelay = RETRY_DELAY
+    while True:
+        if timeKey and firstLine:
+            sendTime(config, senderPath_, firstLine, timeKey, time() - started)
+            timeKey = None
+
+        left = deadline - (time() - started)
+        if not pending or left <= 0:
+            break
+
+        sleep(min(retryDelay, left))   # give server time to process LLD
+        retryDelay *= 2
+
+        pending = sendBatches(config, senderPath_, pending)
+
+    return pending
+
+
 def send():
 
     if fetchMode == 'get':
-        sleep(timeout)   # wait for LLD to be processed by server
-        senderProc = subprocess.Popen([senderPath, '-c', agentConf, '-i', '-'],
-                                      stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
-
-    elif fetchMode == 'getverb':
-        print('\n  Note: the sender will fail if server did not gather LLD previously.')
-        print('\n  Data sent to zabbix sender:')
-        print('\n')
-        print(senderDataNStr)
-        senderProc = subprocess.Popen([senderPath, '-vv', '-c', agentConf, '-i', '-'],
-                                      stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+        sendWithRetries(agentConf, senderPath, sys.stdin, timeout, sendTimeKey)   # items are sent as they come
+        return
 
-    else:
+    elif fetchMode != 'getverb':
         print(sys.argv[0] + " : Not supported. Use 'get' or 'getverb'.")
         sys.exit(1)
 
+    senderDataNStr = sys.stdin.read()
+    started = time()
+    if senderPath == 'native':
+        print('\n  Data sent to built-in sender:\n')
+        print(senderDataNStr)
+        sendNative(agentConf, senderDataNStr, isVerbose=True)
+        print('\n  Send time: %.3f seconds' % (time() - started))
+        return
+
+    print('\n  Note: the sender will fail if server did not gather LLD previously.')
+    print('\n  Data sent to zabbix sender:')
+    print('\n')
+    print(senderDataNStr)
+    senderProc = subprocess.Popen([senderPath, '-vv', '-c', agentConf, '-i', '-'],
+                                  stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+
     senderProc.communicate(input=senderDataNStr)
+    print('\n  Send time: %.3f seconds' % (time() - started))
 
 
 if __name__ == '__main__':
@@ -41,8 +379,10 @@ if __name__ == '__main__':
 
     agentConf = sys.argv[2]
     senderPath = sys.argv[3]
-    timeout = int(sys.argv[4])
-    senderDataNStr = sys.argv[5]
+    timeout = int(sys.argv[4])   # how long failed items are resent
+    sendTimeKey = None
+    if len(sys.argv) > 5:
+        sendTimeKey = sys.argv[5]   # item for duration of sending
 
     if isWindows():
         timeout = 0
@@ -71,6 +411,10 @@ def displayVersions(config, senderPath_):
     
     oldPythonMsg()
 
+    if senderPath_ == 'native':
+        print('\n  Sender version:\n built-in, server is taken from ServerActive\n')
+        return
+
     try:
         print('\n  Sender version:\n', subprocess.check_output([senderPath_, '-V']).decode())
     except:
@@ -118,56 +462,103 @@ def chooseDevnull():
     try:
         from subprocess import DEVNULL   # for python versions greater than 3.3, inclusive
     except:
-        import os
         DEVNULL = open(os.devnull, 'w')  # for 3.0-3.2, inclusive
         
     return DEVNULL
 
 
-def processData(senderData_, jsonData_, agentConf_, senderPyPath_, senderPath_,
-                timeout_, host_, issuesLink_, sendStatusKey_='UNKNOWN'):
-    '''Compose data and try to send it.'''
+def passData(proc_, dataStr_):
+    '''Write data to process stdin and close it without waiting for the process.'''
+    proc_.stdin.write(dataStr_)
+    proc_.stdin.close()
+
+
+# stands for Popen of sender_wrapper.py when sending from a forked child
+ForkedSender = namedtuple('ForkedSender', ('pid', 'stdin'))
+
+
+def forkSender(agentConf_, senderPath_, timeout_, sendTimeKey_=None):
+    '''Send from a forked child of this process, without starting another interpreter.
+    Must be called before any threads are started.'''
+    readFd, writeFd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(writeFd)
+            os.setsid()   # detach, the agent waits only for the parent
+            devnull = os.open(os.devnull, os.O_RDWR)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            sendWithRetries(agentConf_, senderPath_, os.fdopen(readFd), int(timeout_), sendTimeKey_)
+        finally:
+            os._exit(0)
+
+    os.close(readFd)
+
+    return ForkedSender(pid, os.fdopen(writeFd, 'w', 1))
+
+
+def openSender(agentConf_, senderPyPath_, senderPath_, timeout_, host_, sendStatusKey_='UNKNOWN', sendTimeKey_=None,
+               isFork_=False):
+    '''Spawn sender_wrapper.py for get mode, or fork if isFork_ and possible. Items written to its stdin are sent
+    in batches as they come, closing stdin ends the input. None if it could not be started.'''
     DEVNULL = chooseDevnull()
 
+    if isFork_ and hasattr(os, 'fork'):
+        try:
+            return forkSender(agentConf_, senderPath_, timeout_, sendTimeKey_)
+        except OSError:
+            pass   # spawn as usual
+
+    # spawn new process and regain shell control immediately (on Win 'sender_wrapper.py' will not wait)
+    try:
+        cmd = [sys.executable, senderPyPath_, 'get', agentConf_, senderPath_, timeout_]
+        if sendTimeKey_:
+            cmd.append(sendTimeKey_)
+
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL, bufsize=1,
+                                universal_newlines=True, close_fds=(not isWindows()))
+
+    except OSError:
+        subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'SEND_OS_ERROR'])
+
+    except:
+        subprocess.call(    [senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'UNKNOWN_SEND_ERROR'])
+
+    return None
+
+
+def processData(senderData_, jsonData_, agentConf_, senderPyPath_, senderPath_,
+                timeout_, host_, issuesLink_, sendStatusKey_='UNKNOWN', sendTimeKey_=None):
+    '''Compose data and try to send it.'''
     fetchMode_ = sys.argv[1]
     senderDataNStr = '\n'.join(senderData_)   # items for zabbix sender separated by newlines
 
-    # pass senderDataNStr to sender_wrapper.py:
+    # pass senderDataNStr to sender_wrapper.py through its stdin, there is no size limit unlike with arguments
     if fetchMode_ == 'get':
-        print(dumps({"data": jsonData_}, indent=4))   # print data gathered for LLD
-
-        # spawn new process and regain shell control immediately (on Win 'sender_wrapper.py' will not wait)
-        try:
-            cmd = [sys.executable, senderPyPath_, fetchMode_, agentConf_, senderPath_, timeout_, senderDataNStr]
-        
-            subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL, close_fds=(not isWindows()))
+        print(dumps({"data": jsonData_}, separators=(',', ':')))   # print data gathered for LLD
 
-        except OSError as e:
-            if e.args[0] == 7:
-                subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'HUGEDATA'])
-            else:
+        senderProc = openSender(agentConf_, senderPyPath_, senderPath_, timeout_, host_, sendStatusKey_, sendTimeKey_)
+        if senderProc:
+            try:
+                passData(senderProc, senderDataNStr)
+            except OSError:
                 subprocess.call([senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'SEND_OS_ERROR'])
 
-        except:
-            subprocess.call(    [senderPath_, '-c', agentConf_, '-s', host_, '-k', sendStatusKey_, '-o', 'UNKNOWN_SEND_ERROR'])
-
     elif fetchMode_ == 'getverb':
         displayVersions(agentConf_, senderPath_)
         readConfig(agentConf_)
 
-        #for i in range(135000): senderDataNStr = senderDataNStr + '0'   # HUGEDATA testing
         try:
             # do not detach if in verbose mode, also skips timeout in 'sender_wrapper.py'
-            cmd = [sys.executable, senderPyPath_, 'getverb', agentConf_, senderPath_, timeout_, senderDataNStr]
-            
-            subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=(not isWindows()))
+            cmd = [sys.executable, senderPyPath_, 'getverb', agentConf_, senderPath_, timeout_]
 
-        except OSError as e:
-            if e.args[0] == 7:   # almost unreachable in case of this script
-                print(sys.argv[0] + ': Could not send anything. Argument list or filepath too long. (HUGEDATA)')   # FileNotFoundError: [WinError 206]
-            else:
-                print(sys.argv[0] + ': Something went wrong. (SEND_OS_ERROR)')
+            senderProc = subprocess.Popen(cmd, stdin=subprocess.PIPE, universal_newlines=True, close_fds=(not isWindows()))
+            passData(senderProc, senderDataNStr)
 
+        except OSError:
+            print(sys.argv[0] + ': Something went wrong. (SEND_OS_ERROR)')
             raise
 
         except:
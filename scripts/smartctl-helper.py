@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Privileged helper: runs smartctl for smartctl-lld.py over a Unix socket, so the collector does not need sudo.
+# Runs as root, see systemd/zabbix-smartctl-helper.service. Enable with HELPER_SOCKET in smartctl-lld.py.
+
+BIN_PATH       = r'/usr/sbin/smartctl'   # absolute path, the helper does not search PATH
+#BIN_PATH      = r'/usr/local/sbin/smartctl'
+
+SOCKET_PATH    = r'/run/zabbix-smartmontools/helper.sock'
+SOCKET_GROUP   = 'zabbix'   # members of this group may use the helper
+MAX_JOBS       = 8          # smartctl processes at once
+MAX_TIMEOUT    = 120        # seconds, upper limit of timeout requested by client
+MAX_REQUEST    = 4096       # bytes
+
+## End of configuration ##
+
+import os
+import re
+import sys
+import grp
+import json
+import threading
+import subprocess
+import socketserver
+
+# options that do not take a value
+FLAGS = ('-a', '-i', '-H', '-A', '-j', '-V', '--scan')
+
+# options with value, value must match
+VALUE_OPTIONS = {
+    '-d': re.compile(r'^[\w+,/]+$'),
+    '-n': re.compile(r'^(never|sleep|standby|idle)(,\d+)?$'),
+    '-t': re.compile(r'^(short|long)$'),   # self-tests started by SELFTEST_*_INTERVAL
+}
+
+DEVICE_RE = re.compile(r'^/dev/[\w/.,:+-]+$')
+
+jobs = threading.BoundedSemaphore(MAX_JOBS)
+
+
+def isAllowed(args_):
+    '''Only reading options, self-tests and device paths, nothing that changes disk settings.'''
+    i = 0
+    while i < len(args_):
+        arg = args_[i]
+        if arg in FLAGS:
+            i += 1
+        elif arg in VALUE_OPTIONS:
+            if i + 1 >= len(args_) or not VALUE_OPTIONS[arg].match(args_[i + 1]):
+                return False
+            i += 2
+        elif DEVICE_RE.match(arg) and os.path.normpath(arg) == arg:   # no '..' out of /dev
+            i += 1
+        else:
+            return False
+
+    return True
+
+
+def runSmartctl(args_, timeout_):
+    '''Reply for the client: returncode and output, or timeout.'''
+    with jobs:
+        proc = subprocess.Popen([BIN_PATH] + args_, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        try:
+            output = proc.communicate(timeout=timeout_)[0]
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return {'timeout': True}
+
+    return {'returncode': proc.returncode, 'output': output}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    '''One JSON request line {"args": [...], "timeout": N}, one JSON reply line.'''
+
+    def handle(self):
+
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST).decode('utf-8'))
+            args = [ str(i) for i in request['args'] ]
+            timeout = min(float(request.get('timeout') or MAX_TIMEOUT), MAX_TIMEOUT)
+        except (ValueError, KeyError, TypeError):
+            reply = {'error': 'Bad request'}
+        else:
+            if isAllowed(args):
+                reply = runSmartctl(args, timeout)
+            else:
+                reply = {'error': 'Not allowed: %s' % ' '.join(args)}
+
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def listen():
+    '''Socket writable by SOCKET_GROUP only.'''
+    socketDir = os.path.dirname(SOCKET_PATH)
+    if not os.path.isdir(socketDir):
+        os.makedirs(socketDir, 0o755)
+
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+    oldUmask = os.umask(0o117)
+    try:
+        server = Server(SOCKET_PATH, Handler)
+    finally:
+        os.umask(oldUmask)
+
+    os.chown(SOCKET_PATH, 0, grp.getgrnam(SOCKET_GROUP).gr_gid)
+
+    return server
+
+
+if __name__ == '__main__':
+
+    if sys.version_info.major != 3:
+        sys.stdout.write(sys.argv[0] + ': Python3 is required.')
+        sys.exit(1)
+
+    listen().serve_forever()
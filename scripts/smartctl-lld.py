@@ -7,6 +7,10 @@ BIN_PATH             = r'smartctl'
 #BIN_PATH            = r'C:\Program Files\smartmontools\bin\smartctl.exe'         # if smartctl isn't in PATH
 #BIN_PATH            = r'/usr/local/sbin/smartctl'
 
+# smartctl-helper.py runs smartctl instead of sudo when its socket exists. Linux, BSD
+HELPER_SOCKET        = r''
+#HELPER_SOCKET       = r'/run/zabbix-smartmontools/helper.sock'
+
 # path to second send script
 SENDER_WRAPPER_PATH  = r'/etc/zabbix/scripts/sender_wrapper.py'                   # Linux
 #SENDER_WRAPPER_PATH = r'C:\Program Files\Zabbix Agent\scripts\sender_wrapper.py' # Win
@@ -19,17 +23,90 @@ AGENT_CONF_PATH      = r'/etc/zabbix/zabbix_agentd.conf'
 
 SENDER_PATH          = r'zabbix_sender'                                           # Linux, BSD
 #SENDER_PATH         = r'C:\Program Files\Zabbix Agent\zabbix_sender.exe'         # Win
+#SENDER_PATH         = r'native'                                                  # built-in sender, no TLS support
+
+SEND_DEADLINE = '120'   # data is sent right away. When discovery has changed, items not yet created by server
+                        # are resent for this many seconds (does not affect windows)
+                        # this setting MUST be lower than 'Update interval' in discovery rule
 
-DELAY = '50'   # how long the script must wait between LLD and sending, increase if data received late (does not affect windows)
-               # this setting MUST be lower than 'Update interval' in discovery rule
+IS_FORK_SENDER = False   # send from a forked child instead of starting sender_wrapper.py, saves an interpreter start
+                         # on every run. Ignored on Windows
 
 PER_DISK_TIMEOUT = 8   # Single disk query can not exceed this value. Python33 or above required.
 
-IS_SKIP_DUPLICATES = True  # skip duplicate disk outputs. 'DriveStatus' json will not be skipped
+ADAPTIVE_TIMEOUT_FACTOR = 0   # disk timeout is this many times its slowest recent query, up to PER_DISK_TIMEOUT. 0 disables
+                              # spun down HDDs need 5-10 seconds to answer, keep disabled if they are allowed to sleep
+ADAPTIVE_TIMEOUT_MIN = 3      # seconds, adaptive timeout is never lower
+LATENCY_HISTORY = 10          # recent queries remembered per disk
+
+BREAKER_THRESHOLD = 3     # disk is skipped after this many timeouts in a row. 0 disables
+BREAKER_COOLDOWN = 3600   # seconds to skip it for, then it is tried once again
+
+IS_STANDBY_CHECK = False        # do not spin up sleeping HDDs ('-n standby'), their last values are sent instead
+STANDBY_MAX_STALENESS = 86400   # seconds. A sleeping disk is woken up for a full read when its values are older
+
+SELFTEST_SHORT_INTERVAL = 0   # seconds between short self-tests the script starts on every disk. 0 disables
+SELFTEST_LONG_INTERVAL = 0    # same for long (extended) self-tests, they take hours on HDDs. 0 disables
+SELFTEST_PER_CONTROLLER = 1   # self-tests running at once behind one RAID controller, and on directly attached disks
+SELFTEST_MAX_RUNNING = 2      # self-tests running at once on the host. Disks with a running test are never disturbed
+
+FULL_POLL_INTERVAL = 0   # seconds between full reads of a disk ('-a', with logs and identity). In between only health
+                         # and attributes are read ('-H -A'), the rest is taken from the last full read. 0 reads all every run
+                         # how often identity fields are sent is set by STATIC_SEND_INTERVAL
+
+MAX_WORKERS = 4    # how many disks are queried at once. 1 disables concurrency. CSMI disks are always queried one by one
+RUN_TIMEOUT = 0    # wall-clock budget for querying all disks, seconds. 0 disables. Should be lower than agent's 'Timeout'
+
+IS_SKIP_DUPLICATES = True  # skip duplicate disk outputs. 'DriveStatus' json will not be skipped. Multipath aliases
+                           # known by sysfs WWID or from the previous run are not queried at all
                            # determined by disk serial, model, capacity and firmware (serial + at least one of others)
 
+ENGINE = 'auto'    # 'json' for smartmontools >= 7, 'text' for older ones, 'auto' to decide by smartctl version
+
 IS_CHECK_NVME = False      # Additional overhead. Should be disabled if smartmontools is >= 7 or NVMe is absent.
 
+SCAN_CACHE_TTL = 3600   # reuse found disks and smartctl version for this many seconds, 0 disables. Disk hotplug resets
+                        # found disks on Linux
+
+STATIC_SEND_INTERVAL = 0   # identity fields are sent only when changed or once per this many seconds. 0 sends them every run
+                           # remembered by disk ident of item keys: serial in 'serial' MODE, device name in 'device' MODE
+                           # a value sent before the server created its item is lost until the next resend
+STATIC_FIELDS = ('family', 'model', 'serial', 'firmware', 'formFactor', 'rpm', 'capacity', 'manufacturedYear',
+                 'vendor', 'revision', 'compliance', 'sataVersion', 'bandwidthMax')
+
+IS_SEND_CHANGES_ONLY = False   # send disk values only when changed since last run, and all of them once per HEARTBEAT_INTERVAL
+HEARTBEAT_INTERVAL = 3600      # seconds. Must be lower than nodata() periods in triggers
+
+# growth per day and days left until raw value reaches threshold, computed from values kept on host. Empty disables
+TREND_THRESHOLDS = {'5': 100, '197': 10, '198': 10, 'defects': 100}   # SATA attribute number or SAS item: threshold
+TREND_SAMPLES = 32             # values kept per disk and attribute, oldest are dropped
+TREND_SAMPLE_INTERVAL = 21600  # seconds, runs in between do not add a value
+TREND_MIN_SPAN = 86400         # seconds of history needed before trends are sent
+
+# place for daemon results and caches, must be writable by zabbix user
+STATE_DIR            = r'/var/tmp/zabbix-smartmontools'                           # Linux, BSD
+#STATE_DIR           = r'C:\ProgramData\zabbix-smartmontools'                     # Win
+
+# 'smartctl-lld.py daemon HOST' polls disks on its own, agent calls are then answered from its results
+DAEMON_INTERVAL = 300   # seconds between daemon polls
+DAEMON_MAX_AGE = 900    # older daemon results are ignored and disks are queried directly
+DAEMON_HTTP_PORT = 0    # daemon serves its latest results as one JSON document over HTTP on this port. 0 disables
+DAEMON_HTTP_ADDRESS = '127.0.0.1'
+
+# the same results are also written to these files after every run that queried disks. Empty disables
+TEXTFILE_PATH        = r''   # node_exporter textfile collector, name must end with .prom
+#TEXTFILE_PATH       = r'/var/lib/prometheus/node-exporter/smartctl.prom'
+SNAPSHOT_PATH        = r''   # JSON document as printed by 'getall'
+#SNAPSHOT_PATH       = r'/var/tmp/zabbix-smartmontools/snapshot.json'
+
+# RAID controllers whose slots are probed for disks, in addition to scan or manual list. Empty slots are remembered
+RAID_CONTROLLERS = []
+#RAID_CONTROLLERS = ['/dev/bus/0 -d megaraid', '/dev/twa0 -d 3ware', '/dev/sg1 -d areca', '/dev/cciss/c0d0 -d cciss']
+RAID_MAX_SLOTS = 32            # slots probed per controller
+RAID_RESCAN_INTERVAL = 86400   # seconds until empty slots are probed again
+RAID_PROBE_TIME = 10           # seconds per run spent probing slots, the rest is probed on next runs. 0 probes all at once
+CONTROLLER_WORKERS = 1         # disks of one controller queried at once, controllers serialize commands internally
+
 # manually provide disk list or RAID configuration if needed
 DISK_DEVS_MANUAL = []
 # like this:
@@ -38,29 +115,53 @@ DISK_DEVS_MANUAL = []
 
 ## End of configuration ##
 
+import os
 import sys
 import subprocess
 import re
 import shlex
-from sender_wrapper import (readConfig, processData, clearDiskTypeStr, sanitizeStr, fail_ifNot_Py3)
+import time
+import zlib
+import threading
+from json import loads, dumps
+from collections import namedtuple
+from sender_wrapper import (readConfig, processData, openSender, passData, clearDiskTypeStr, sanitizeStr,
+                            fail_ifNot_Py3)
 
 HOST = sys.argv[2]
 
+# text output, split into 'Label: value' lines, SMART attributes table and the reason of absent SMART
+TextTokens = namedtuple('TextTokens', ('labels', 'attributes', 'why'))
+
+ATTRIBUTE_RE     = re.compile(r'^(?:\s+)?(\d+)\s+([\w-]+)\s+[\w-]+\s+\d{3}\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+(\d+)')
+MANUFACTURED_RE  = re.compile(r'^Manufactured in week \d+ of year (\d+)', re.I)
+POWERED_HOURS_RE = re.compile(r'^number of hours powered up \=\s+(\d+)', re.I)
+NUMBER_RE        = re.compile(r'(\d+)')
+RPM_RE           = re.compile(r'(\d+)\s+rpm$', re.I)
+CAPACITY_RE      = re.compile(r'(.+)bytes', re.I)
+BANDWIDTH_RE     = re.compile(r'.+,\s+(\d+\.\d+)\s+Gb\/s', re.I)
+BANDWIDTH_CUR_RE = re.compile(r'.+current\:\s+(\d+\.\d+)\s+Gb\/s', re.I)
+
+TEST_CODE_RE     = re.compile(r'^\(\s*(\d+)\)')   # 'Self-test execution status' value
+TEST_DONE_RE     = re.compile(r'(\d+)% completed', re.I)   # NVMe 'Self-test status' value
+TEST_FIELDS_RE   = re.compile(r'\s{2,}')   # self-test log row columns
+
+DISK_KEY_RE      = re.compile(r'^smartctl\.\w+\[([^,\]]+),')   # disk ident of item key
+ITEM_KEY_RE      = re.compile(r'^smartctl\.(\w+)\[(.+)\]$')   # item kind and parameters
+NUMERIC_RE       = re.compile(r'^-?\d+(\.\d+)?$')
+
+# textfile labels by number of item key parameters
+METRIC_LABELS = {1: ('item',), 2: ('disk', 'item'), 3: ('disk', 'item', 'stat')}
+
 
 def findIdent(p_, devName_):
 
-    identPatterns = (
-        r'^Serial Number:\s+(.+)$',
-        r'^LU WWN Device Id:\s+(.+)$',
-        r'^Logical Unit id:\s+(.+)$',
-    )
+    if isinstance(p_, dict):
+        return findIdentJson(p_, devName_)
 
-    ident = None
-    for i in identPatterns:
-        identRe = re.search(i, p_, re.I | re.M)
-        if identRe:
-            ident = sanitizeStr(identRe.group(1))
-            break
+    ident = findLabel(p_, ('serial number', 'lu wwn device id', 'logical unit id'))
+    if ident:
+        ident = sanitizeStr(ident)
 
     if not ident:
         ident = devName_
@@ -71,15 +172,15 @@ def findIdent(p_, devName_):
 def scanDisks(mode_):
     '''Determines available disks. Can be skipped.'''
     if   mode_ == 'NOTYPE':
-        cmd = addSudoIfNix([BIN_PATH, '--scan'])
+        args = ['--scan']
     elif mode_ == 'NVME':
-        cmd = addSudoIfNix([BIN_PATH, '--scan', '-d', 'nvme'])
+        args = ['--scan', '-d', 'nvme']
     else:
         print('Invalid type %s. Terminating.' % mode_)
         sys.exit(1)
 
     try:
-        p = subprocess.check_output(cmd, universal_newlines=True)
+        p = runSmartctl(args)
         error = ''
     except OSError as e:
         p = ''
@@ -105,13 +206,18 @@ def scanDisks(mode_):
     return error, disks
 
 
+def isCsmi(disk):
+
+    return bool(re.search(r'\/csmi\d+\,\d+', disk, re.I))
+
+
 def moveCsmiToBegining(disks):
 
     csmis = []
     others = []
 
     for i in disks:
-        if re.search(r'\/csmi\d+\,\d+', i, re.I):
+        if isCsmi(i):
             csmis.append(i)
         else:
             others.append(i)
@@ -121,11 +227,154 @@ def moveCsmiToBegining(disks):
     return result
 
 
+def findHotplugStamp():
+    '''Changes when devices are added or removed. Empty on systems without /dev and sysfs.'''
+    stamp = []
+    for i in ('/dev', '/sys/block'):
+        try:
+            stamp.append(os.stat(i).st_mtime)
+        except OSError:
+            pass
+
+    try:
+        with open('/sys/kernel/uevent_seqnum') as f:
+            stamp.append(f.read().strip())
+    except (IOError, OSError):
+        pass
+
+    return stamp
+
+
+def loadScanCache():
+    '''Disks found by previous scan, or None if cache is expired.'''
+    if not SCAN_CACHE_TTL:
+        return None
+
+    cache = loadState('scan')
+    if     (cache.get('isCheckNvme') == IS_CHECK_NVME and
+            cache.get('raidControllers', []) == RAID_CONTROLLERS and
+            cache.get('stamp') == findHotplugStamp() and
+            time.time() - cache.get('time', 0) < SCAN_CACHE_TTL):
+
+        return cache.get('disks')
+
+    return None
+
+
+def listSlots(controller_):
+    '''Slot devices of a controller like '/dev/twa0 -d 3ware'.'''
+    typeRe = re.search(r'-d\s+(\S+)', controller_)
+    if not typeRe:
+        return []
+
+    first = 0
+    if typeRe.group(1).endswith('areca'):   # areca ports start from 1
+        first = 1
+
+    return [ '%s,%s' % (controller_, slot) for slot in range(first, first + RAID_MAX_SLOTS) ]
+
+
+def probeSlot(device_, deadline_=None):
+    '''True if the slot is occupied. Empty slots fail to open right away. None if deadline_ came first.'''
+    timeout = PER_DISK_TIMEOUT
+    if deadline_:
+        timeout = min(timeout, deadline_ - time.time())
+        if timeout <= 0:
+            return None
+
+    try:
+        runSmartctl(['-i'] + shlex.split(device_), timeout)
+    except subprocess.CalledProcessError as e:
+        if e.returncode & 2:   # device open failed
+            return False
+    except subprocess.TimeoutExpired:
+        if deadline_ and time.time() >= deadline_:
+            return None
+        return False
+    except OSError:
+        return False
+
+    return True
+
+
+def probeSlots(slots_):
+    '''Probe slots in the lanes of their controllers, within RAID_PROBE_TIME. {slot: probeSlot() result}.'''
+    deadline = None
+    if RAID_PROBE_TIME:
+        deadline = time.time() + RAID_PROBE_TIME
+
+    occupied = {}
+    def probeLane(lane_):
+        for slot in lane_:
+            occupied[slot] = probeSlot(slot, deadline)
+
+    lanes = findLanes(slots_)
+    ThreadPoolExecutor = None
+    if MAX_WORKERS > 1 and len(lanes) > 1:
+        ThreadPoolExecutor = findExecutor()
+
+    if ThreadPoolExecutor:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(probeLane, lanes))
+    else:
+        for lane in lanes:
+            probeLane(lane)
+
+    return occupied
+
+
+def listControllerDisks():
+    '''Disks behind RAID_CONTROLLERS and whether all their slots are probed. Slots found empty are not probed until
+    RAID_RESCAN_INTERVAL passes. Slots not reached within RAID_PROBE_TIME stay 'pending' and are probed on next runs.'''
+    state = loadState('raid')
+    stateNew = {}
+
+    pending = []
+    for controller in RAID_CONTROLLERS:
+        known = state.get(controller, {})
+        if     (not known.get('pending') and
+                time.time() - known.get('time', 0) >= RAID_RESCAN_INTERVAL):
+
+            known = {'time': known.get('time', 0), 'disks': known.get('disks', []), 'found': [],
+                     'pending': listSlots(controller)}
+
+        stateNew[controller] = known
+        pending.extend(known.get('pending', []))
+
+    if pending:
+        occupied = probeSlots(pending)
+        for controller, known in stateNew.items():
+            if not known.get('pending'):
+                continue
+
+            known['found'] = known['found'] + [ i for i in known['pending'] if occupied.get(i) ]
+            known['pending'] = [ i for i in known['pending'] if occupied.get(i) is None ]
+            if not known['pending']:   # all slots probed
+                stateNew[controller] = {'time': time.time(), 'disks': known['found']}
+
+    disks = []
+    isProbed = True
+    for controller in RAID_CONTROLLERS:
+        known = stateNew[controller]
+        if known.get('pending'):
+            isProbed = False
+        disks.extend(known['disks'])   # of the previous probe while a new one is not complete
+        disks.extend([ i for i in known.get('found', []) if i not in known['disks'] ])
+
+    saveState('raid', stateNew)
+
+    return disks, isProbed
+
+
 def listDisks():
 
     errors = []
 
     if not DISK_DEVS_MANUAL:
+        cachedDisks = loadScanCache()
+        if cachedDisks is not None:
+            return ['', ''], cachedDisks
+
         scanDisks_Out = scanDisks('NOTYPE')
         errors.append(scanDisks_Out[0])   # SCAN_OS_NOCMD_*, SCAN_OS_ERROR_*, SCAN_UNKNOWN_ERROR_*
 
@@ -142,51 +391,225 @@ def listDisks():
     else:
         disks = DISK_DEVS_MANUAL 
 
+    isProbed = True
+    if RAID_CONTROLLERS:
+        listControllerDisks_Out = listControllerDisks()
+        disks = disks + listControllerDisks_Out[0]
+        isProbed = listControllerDisks_Out[1]
+
     # Remove duplicates preserving order
     diskResult = []
+    seen = set()
     for i in disks:
-        if i not in diskResult:
+        if i not in seen:
+            seen.add(i)
             diskResult.append(i)
 
     diskResult = moveCsmiToBegining(diskResult)
 
+    if     (SCAN_CACHE_TTL and
+            not DISK_DEVS_MANUAL and
+            not any(errors) and
+            isProbed):   # slots left to probe are listed on next run
+
+        saveState('scan', {'time': time.time(), 'stamp': findHotplugStamp(), 'isCheckNvme': IS_CHECK_NVME,
+                           'raidControllers': RAID_CONTROLLERS, 'disks': diskResult})
+
     return errors, diskResult
 
 
-def findAny(valuesRaw_):
+def findWwid(devPath_):
+    '''WWID of a Linux SCSI disk from sysfs, same for all paths of a multipath disk. None for other devices.'''
+    deviceRe = re.match(r'^/dev/(sd[a-z]+)(?:\s+-d\s+[\w+]+)?$', devPath_)   # no ',N', not a disk behind controller
+    if not deviceRe:
+        return None
+
+    try:
+        with open('/sys/block/%s/device/wwid' % deviceRe.group(1)) as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def findAliases(disks_):
+    '''Paths of a disk already listed under another path: {alias: primary}. Found before querying by sysfs WWID,
+    and by idents of the previous run while no device was added or removed.'''
+    state = loadState('idents')
+    known = {}
+    if state.get('stamp') == findHotplugStamp():
+        known = state.get('idents', {})
+
+    primaries = {}
+    aliases = {}
+    for i in disks_:
+        for identity in (('wwid', findWwid(i)), ('ident', known.get(i))):
+            if not identity[1]:
+                continue
+
+            if identity in primaries:
+                aliases[i] = primaries[identity]
+                break
+            primaries[identity] = i
+
+    return aliases
+
+
+def isJsonCapable():
+    '''Determines if smartctl can produce JSON output. The answer is reused for SCAN_CACHE_TTL like found disks.'''
+    if ENGINE != 'auto':
+        return ENGINE == 'json'
+
+    if SCAN_CACHE_TTL:
+        cache = loadState('version')
+        if     (cache.get('binPath') == BIN_PATH and
+                time.time() - cache.get('time', 0) < SCAN_CACHE_TTL):
+
+            return cache.get('isJson', False)
+
+    try:
+        p = subprocess.check_output([BIN_PATH, '-V'], universal_newlines=True)
+    except:
+        return False   # not cached, smartctl may be installed later
+
+    isJson = False
+    versionRe = re.search(r'^smartctl\s+(\d+)\.', p, re.M)
+    if versionRe and int(versionRe.group(1)) >= 7:
+        isJson = True
+
+    if SCAN_CACHE_TTL:
+        saveState('version', {'time': time.time(), 'binPath': BIN_PATH, 'isJson': isJson})
+
+    return isJson
+
+
+def loadJson(p_):
+
+    try:
+        doc = loads(p_)
+    except ValueError:
+        doc = {}
+
+    if not isinstance(doc, dict):
+        doc = {}
+
+    return doc
+
+
+def parseOutput(p_, isJson_):
 
-    value = None
-    for mixed in valuesRaw_:
-        if   isinstance(mixed, str):
-            value = mixed
+    if isJson_:
+        return loadJson(p_)
+
+    return tokenizeOutput(p_)
+
+
+def tokenizeOutput(p_):
+    '''Walks smartctl text output once. Labels are lowercase, only first occurrence is kept.'''
+    labels = {}
+    attributes = []
+    whys = set()
+
+    for line in p_.splitlines():
+        first = line[:1]
+        if first.isdigit() or first == ' ':
+            attributeRe = ATTRIBUTE_RE.match(line)
+            if attributeRe:
+                attributes.append(attributeRe.groups())
+                continue
+
+        lineLower = line.lower()
+        if 'unknown usb bridge' in lineLower:
+            whys.add('SMART_UNK_USB_BRIDGE')
+
+        if not first.strip():
+            continue
+
+        label, sep, rest = line.partition(':')
+        if sep:
+            label = label.lower()
+            value = rest.strip()
+            if value and rest[:1].isspace():
+                labels.setdefault(label, value)
+
+            if label == 'smart support is':
+                if   value.startswith('Unavailable - device lacks SMART capability'):
+                    whys.add('SMART_UNAVAILABLE')
+                elif value.startswith('Unavailable - Packet Interface Devices'):
+                    whys.add('SMART_UNAVAILABLE_PID')
+                elif value.startswith('Disabled'):
+                    whys.add('SMART_DISABLED')
+
+        elif lineLower.startswith('manufactured in week'):
+            manufacturedRe = MANUFACTURED_RE.match(line)
+            if manufacturedRe:
+                labels.setdefault('manufactured year', manufacturedRe.group(1))
+
+        elif first == '#' and line.startswith('# 1 '):   # latest self-test log entry
+            labels.setdefault('self-test log', line)
+
+        elif lineLower.startswith('number of hours powered up'):
+            poweredRe = POWERED_HOURS_RE.match(line)
+            if poweredRe:
+                labels.setdefault('number of hours powered up', poweredRe.group(1))
+
+    why = None
+    for i in ('SMART_UNAVAILABLE', 'SMART_UNAVAILABLE_PID', 'SMART_DISABLED', 'SMART_UNK_USB_BRIDGE'):
+        if i in whys:
+            why = i
             break
-        elif isinstance(mixed, tuple):
-            for string in mixed:
-                if (isinstance(string, str) and string != ''):
-                    value = string
-                    break
 
-    return value
+    return TextTokens(labels, attributes, why)
+
+
+def findLabel(tokens_, labels_, pattern_=None):
+    '''First present label's value, or first group of pattern_ matched against it.'''
+    for i in labels_:
+        value = tokens_.labels.get(i)
+        if not value:
+            continue
+
+        if not pattern_:
+            return value
 
+        valueRe = pattern_.match(value)
+        if valueRe:
+            return valueRe.group(1)
 
-def findProcOut(devicePath_):
+    return None
 
+
+def findProcOut(devicePath_, deadline_=None, isJson_=False, timeout_=None, options_=('-a',)):
+    '''Returns (msg, parsed output, smartctl exec time, parse time).
+    msg is STANDBY or SLEEP if options_ have '-n' and the disk was not spun up, DISKFATAL_RUN_TIMEOUT if deadline_
+    came before the disk's own timeout.'''
     if not DISK_DEVS_MANUAL:
         devicePath_ = devicePath_.replace('-d scsi', '-d auto')   # bug handling; prevent empty results
 
+    timeout = timeout_ or PER_DISK_TIMEOUT
+    isClipped = False
+    if deadline_:
+        if deadline_ - time.time() < timeout:
+            timeout = deadline_ - time.time()
+            isClipped = True
+        if timeout <= 0:
+            return 'DISKFATAL_RUN_TIMEOUT', parseOutput('', isJson_), 0, 0
+
+    started = time.time()
     p = ''
     msg = None
     try:
-        cmd = addSudoIfNix([BIN_PATH, '-a']) + shlex.split(devicePath_)
+        args = list(options_) + shlex.split(devicePath_)
+        if isJson_:
+            args.append('-j')
 
         if      (sys.version_info.major == 3 and
                  sys.version_info.minor <= 2):
 
-            p = subprocess.check_output(cmd, universal_newlines=True)
+            p = runSmartctl(args)
  
             msg = 'ERR_PYTHON32_OR_LESS'
         else:
-            p = subprocess.check_output(cmd, universal_newlines=True, timeout=PER_DISK_TIMEOUT)
+            p = runSmartctl(args, timeout)
 
     except OSError as e:
         if e.args[0] == 2:
@@ -205,10 +628,14 @@ def findProcOut(devicePath_):
         Bit 6 = Code 64
         Bit 7 = Code 128
         '''
-        p = e.output
-
-        if whyNoSmart(p):
-            msg = str(whyNoSmart(p))
+        p = parseOutput(e.output, isJson_)
+
+        why = whyNoSmart(p)
+        standbyRe = re.search(r'Device is in (STANDBY|SLEEP) mode', str(e.output))
+        if '-n' in options_ and standbyRe:
+            msg = standbyRe.group(1)
+        elif why:
+            msg = str(why)
         elif e.args[0] == 1 or e.args[0] == 2:
             msg = 'DISKFATAL_ERR_CODE_%s' % (str(e.args[0]))
         else:
@@ -216,6 +643,8 @@ def findProcOut(devicePath_):
 
     except subprocess.TimeoutExpired:
         msg = 'DISKFATAL_TIMEOUT'
+        if isClipped:   # run is out of time, says nothing about the disk
+            msg = 'DISKFATAL_RUN_TIMEOUT'
 
     except:
         p = e.output
@@ -226,80 +655,316 @@ def findProcOut(devicePath_):
     else:
         msg = 'PROCESSED'   # fallback
 
-    return msg, p
+    execTime = time.time() - started   # includes parsing of failed runs
+
+    started = time.time()
+    if isinstance(p, str):
+        p = parseOutput(p, isJson_)
+    parseTime = time.time() - started
+
+    return msg, p, execTime, parseTime
+
+
+def findController(disk_):
+    '''Controller of a disk behind RAID, like '/dev/bus/0 megaraid' for '/dev/bus/0 -d sat+megaraid,4'. None otherwise.'''
+    controllerRe = re.match(r'^(\S+)\s+-d\s+(?:\w+\+)?(\w+),\d+', disk_)
+    if controllerRe:
+        return '%s %s' % (controllerRe.group(1), controllerRe.group(2))
+
+    return None
+
+
+def findLanes(disks_):
+    '''Split disks into lists queried one after another. Disks of a controller share CONTROLLER_WORKERS lanes.'''
+    lanes = []
+    controllerLanes = {}
+    for i in disks_:
+        controller = findController(i)
+        if not controller:
+            lanes.append([i])
+            continue
+
+        if controller not in controllerLanes:
+            controllerLanes[controller] = [ [] for j in range(max(1, CONTROLLER_WORKERS)) ]
+            lanes.extend(controllerLanes[controller])
+
+        lane = min(controllerLanes[controller], key=len)
+        lane.append(i)
+
+    return [ i for i in lanes if i ]
+
+
+def findDiskTimeout(diskLatency_):
+    '''Per-disk timeout from recent query times. Timed out queries are remembered with the timeout they had.'''
+    times = diskLatency_.get('times')
+    if not ADAPTIVE_TIMEOUT_FACTOR or not times:
+        return PER_DISK_TIMEOUT
+
+    return min(PER_DISK_TIMEOUT, max(ADAPTIVE_TIMEOUT_MIN, max(times) * ADAPTIVE_TIMEOUT_FACTOR))
+
+
+def isBreakerOpen(diskLatency_):
+    '''Disk timed out too many times in a row and its cooldown has not passed.'''
+    return (BREAKER_THRESHOLD and
+            diskLatency_.get('timeouts', 0) >= BREAKER_THRESHOLD and
+            time.time() < diskLatency_.get('skipUntil', 0))
+
+
+def updateLatency(diskLatency_, out_, timeout_):
+    '''Remember query time of the disk and count its timeouts in a row.'''
+    msg = out_[0]
+    execTime = out_[2]
+
+    if msg in ('STANDBY', 'SLEEP'):   # says nothing about a full query
+        return
+
+    if msg == 'DISKFATAL_TIMEOUT':
+        execTime = timeout_
+        diskLatency_['timeouts'] = diskLatency_.get('timeouts', 0) + 1
+        if BREAKER_THRESHOLD and diskLatency_['timeouts'] >= BREAKER_THRESHOLD:
+            diskLatency_['skipUntil'] = time.time() + BREAKER_COOLDOWN
+    else:
+        diskLatency_['timeouts'] = 0
+
+    diskLatency_['times'] = (diskLatency_.get('times', []) + [round(execTime, 3)])[-LATENCY_HISTORY:]
+
+
+def findExecutor():
+    '''ThreadPoolExecutor, None below python32. Imported only when needed, it takes longer than the rest.'''
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        return None
+
+    return ThreadPoolExecutor
+
+
+def collectDisks(disks_, isJson_=False, options_={}):
+    '''Query all disks, concurrently if possible. Results are yielded in the order of disks_, each one as soon as
+    it and the disks before it are done. Disks with open breaker are not queried, DISKFATAL_BREAKER_OPEN is
+    yielded for them. options_ are smartctl options by disk, '-a' if absent.'''
+    deadline = None
+    if RUN_TIMEOUT:
+        deadline = time.time() + RUN_TIMEOUT
+
+    latency = loadState('latency')
+    latencyNew = {}   # disks absent in this run are forgotten
+    timeouts = {}
+    results = {}
+
+    queried = []
+    for i in disks_:
+        latencyNew[i] = latency.get(i, {})
+        if isBreakerOpen(latencyNew[i]):
+            results[i] = ('DISKFATAL_BREAKER_OPEN', parseOutput('', isJson_), 0, 0)
+        else:
+            timeouts[i] = findDiskTimeout(latencyNew[i])
+            queried.append(i)
+
+    done = {}
+    for i in queried:
+        done[i] = threading.Event()
+
+    def queryLane(lane_):
+        try:
+            for disk in lane_:
+                results[disk] = findProcOut(disk, deadline, isJson_, timeouts[disk], options_.get(disk, ('-a',)))
+                done[disk].set()
+        finally:
+            for disk in lane_:   # lane has failed, do not keep the caller waiting
+                done[disk].set()
+
+    # CSMI controllers can not be queried concurrently
+    others = []
+    for i in queried:
+        if isCsmi(i):
+            queryLane([i])
+        else:
+            others.append(i)
+
+    executor = None
+    futures = {}
+    lanes = findLanes(others)
+    if MAX_WORKERS > 1 and len(lanes) > 1:
+        ThreadPoolExecutor = findExecutor()
+        if ThreadPoolExecutor:
+            executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    if executor:
+        for lane in lanes:
+            future = executor.submit(queryLane, lane)
+            for disk in lane:
+                futures[disk] = future
+
+    try:
+        for i in disks_:
+            if i in futures:
+                done[i].wait()
+                if i not in results:
+                    futures[i].result()   # raises what the lane has raised
+            elif i not in results:   # one at a time
+                queryLane([i])
+
+            yield results[i]
+            results[i] = (results[i][0], None, results[i][2], results[i][3])   # only status and times are needed later
+    finally:
+        if executor:
+            executor.shutdown()
+
+    for i in queried:
+        if results[i][0] != 'DISKFATAL_RUN_TIMEOUT':   # not queried at all or cut short, not the disk's fault
+            updateLatency(latencyNew[i], results[i], timeouts[i])
+
+    if ADAPTIVE_TIMEOUT_FACTOR or BREAKER_THRESHOLD:
+        saveState('latency', latencyNew)
 
 
 def findSmart(p_, diskIdent_):
 
-    keysAndRegexps = (
-        ('smartctl.info[%s,family]',           r'^Model Family:\s+(.+)$'),
-        ('smartctl.info[%s,model]',            r'^Device Model:\s+(.+)$|^Device:\s+(.+)$|^Product:\s+(.+)$|^Model Number:\s+(.+)$'),
-        ('smartctl.info[%s,selftest]',         r'^SMART overall-health self-assessment test result:\s+(.+)$|^SMART Health Status:\s+(.+)$'),
-        ('smartctl.info[%s,serial]',           r'^Serial Number:\s+(.+)$'),
-        ('smartctl.info[%s,sataVersion]',      r'^SATA Version is:\s+(.+)$'),
-        ('smartctl.info[%s,bandwidthMax]',     r'^SATA Version is:\s+.+,\s+(\d+\.\d+)\s+Gb\/s'),
-        ('smartctl.info[%s,bandwidthCurrent]', r'^SATA Version is:\s+.+current\:\s+(\d+\.\d+)\s+Gb\/s|^SATA Version is:\s+.+,\s+(\d+\.\d+)\s+Gb\/s'),  # magic; second one is 'current' only when first one is absent
-        ('smartctl.info[%s,rpm]',              r'^Rotation Rate:\s+(\d+)\s+rpm$'),
-        ('smartctl.info[%s,formFactor]',       r'^Form Factor:\s+(.+)$'),
-        ('smartctl.info[%s,firmware]',         r'^Firmware Version:\s+(.+)$'),
-        ('smartctl.info[%s,vendor]',           r'^Vendor:\s+(.+)$'),
-        ('smartctl.value[%s,SSDwear]',         r'^Percentage used endurance indicator:\s+(\d+)'),
+    if isinstance(p_, dict):
+        return findSmartJson(p_, diskIdent_)
+
+    keysAndLabels = (
+        ('smartctl.info[%s,family]',           ('model family',), None),
+        ('smartctl.info[%s,model]',            ('device model', 'device', 'product', 'model number'), None),
+        ('smartctl.info[%s,selftest]',         ('smart overall-health self-assessment test result', 'smart health status'), None),
+        ('smartctl.info[%s,serial]',           ('serial number',), None),
+        ('smartctl.info[%s,sataVersion]',      ('sata version is',), None),
+        ('smartctl.info[%s,bandwidthMax]',     ('sata version is',), BANDWIDTH_RE),
+        ('smartctl.info[%s,bandwidthCurrent]', ('sata version is',), BANDWIDTH_CUR_RE),
+        ('smartctl.info[%s,rpm]',              ('rotation rate',), RPM_RE),
+        ('smartctl.info[%s,formFactor]',       ('form factor',), None),
+        ('smartctl.info[%s,firmware]',         ('firmware version',), None),
+        ('smartctl.info[%s,vendor]',           ('vendor',), None),
+        ('smartctl.value[%s,SSDwear]',         ('percentage used endurance indicator',), NUMBER_RE),
     )
     sender = []
     json = []
 
-    json.append({'{#DISKIDBANDWIDTH}':diskIdent_})
-    json.append({'{#DISKIDSSD}':diskIdent_})
-    json.append({'{#DISKID}':diskIdent_})
+    json.append({'{#DISKIDBANDWIDTH}':diskIdent_, '{#DISKIDSSD}':diskIdent_, '{#DISKID}':diskIdent_})   # one row, less LLD
 
     # Parse main disk output
-    for key, regexp in keysAndRegexps:
-        valuesRaw = re.findall(regexp, p_, re.M | re.I)
-        value = findAny(valuesRaw)
+    for key, labels, pattern in keysAndLabels:
+        value = findLabel(p_, labels, pattern)
+        if not value and pattern is BANDWIDTH_CUR_RE:   # no 'current:' part, link runs at max speed
+            value = findLabel(p_, labels, BANDWIDTH_RE)
         if value:
-            sender.append('"%s" %s "%s"' % (HOST, (key % diskIdent_), sanitizeQuotes(value.strip())))
+            sender.append(((key % diskIdent_), value.strip()))
 
     # Special cases <3
-    capacityRe = re.search(r'^User Capacity:\s+(.+)bytes', p_, re.M | re.I)
-    if capacityRe:
-        capacitySub = re.sub(r'\s|\,', '', capacityRe.group(1))
-        sender.append('"%s" smartctl.info[%s,capacity] "%s"' % (HOST, diskIdent_, capacitySub))
+    capacity = findLabel(p_, ('user capacity',), CAPACITY_RE)
+    if capacity:
+        capacitySub = re.sub(r'\s|\,', '', capacity)
+        sender.append(('smartctl.info[%s,capacity]' % diskIdent_, capacitySub))
 
     # Catch number, name and value
     gotValues = False
-    valuesRe = re.findall(r'^(?:\s+)?(\d+)\s+([\w-]+)\s+[\w-]+\s+\d{3}\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+[\w-]+\s+(\d+)', p_, re.M | re.I)
-    if valuesRe:
+    if p_.attributes:
         gotValues = True
-        sender.append('"%s" smartctl.info[%s,SmartStatus] "SMART_SATA"' % (HOST, diskIdent_))
-        for num, name, val in valuesRe:
-            sender.append('"%s" smartctl.value[%s,%s] %s' % (HOST, diskIdent_, num, val))
+        sender.append(('smartctl.info[%s,SmartStatus]' % diskIdent_, 'SMART_SATA'))
+        for num, name, val in p_.attributes:
+            sender.append(('smartctl.value[%s,%s]' % (diskIdent_, num), val))
             json.append({('{#DVALUE%s}' % num):diskIdent_, '{#SMARTNAME}':name})
 
     return sender, json, gotValues
 
 
+def findTestStatus(p_):
+    '''Self-test state: (is running, percent remaining or None if unknown, last logged test like 'Short offline:
+    Completed without error' or None).'''
+    if isinstance(p_, dict):
+        return findTestStatusJson(p_)
+
+    isRunning = False
+    remaining = None
+
+    code = findLabel(p_, ('self-test execution status',), TEST_CODE_RE)   # ATA
+    if code is not None:
+        remaining = 0
+        if int(code) >> 4 == 15:   # in progress, low nibble is tens of percent remaining
+            isRunning = True
+            remaining = (int(code) & 15) * 10
+
+    status = findLabel(p_, ('self-test status',))   # NVMe
+    if status and 'in progress' in status.lower():
+        isRunning = True
+        doneRe = TEST_DONE_RE.search(status)
+        if doneRe:
+            remaining = 100 - int(doneRe.group(1))
+
+    last = None
+    row = p_.labels.get('self-test log')
+    if row:
+        fields = TEST_FIELDS_RE.split(row.strip())   # '# 1', description, status, ...
+        if len(fields) >= 3:
+            last = '%s: %s' % (fields[1], fields[2])
+            if 'in progress' in fields[2].lower():   # SCSI
+                isRunning = True
+
+    return isRunning, remaining, last
+
+
+def findTestStatusJson(doc_):
+
+    isRunning = False
+    remaining = None
+    last = None
+
+    code = findJson(doc_, 'ata_smart_data.self_test.status.value')
+    if code is not None:
+        remaining = 0
+        if code >> 4 == 15:
+            isRunning = True
+            remaining = findJson(doc_, 'ata_smart_data.self_test.status.remaining_percent') or (code & 15) * 10
+
+    operation = findJson(doc_, 'nvme_self_test_log.current_self_test_operation.value')
+    if operation is not None:
+        remaining = 0
+        if operation:
+            isRunning = True
+            remaining = 100 - (findJson(doc_, 'nvme_self_test_log.current_self_test_completion_percent') or 0)
+
+    table = findJson(doc_, 'ata_smart_self_test_log.standard.table') or findJson(doc_, 'nvme_self_test_log.table')
+    if table and isinstance(table[0], dict):
+        description = findJson(table[0], 'type.string') or findJson(table[0], 'self_test_code.string')
+        result = findJson(table[0], 'status.string') or findJson(table[0], 'self_test_result.string')
+        if description and result:
+            last = '%s: %s' % (description, result)
+
+    scsiDescription = findJson(doc_, 'scsi_self_test_0.code.string')
+    scsiResult = findJson(doc_, 'scsi_self_test_0.result.string')
+    if scsiDescription and scsiResult:
+        last = '%s: %s' % (scsiDescription, scsiResult)
+        if 'in progress' in scsiResult.lower():
+            isRunning = True
+
+    return isRunning, remaining, last
+
+
 def findSmartSAS(p_, diskIdent_):
 
-    keysAndRegexpsSAS = (
-        ('smartctl.info[%s,revision]',         r'^Revision:\s+(.+)$|^Version:\s+(.+)$'),
-        ('smartctl.info[%s,compliance]',       r'^Compliance:\s+(.+)$'),
-        ('smartctl.info[%s,manufacturedYear]', r'^Manufactured in week \d+ of year (\d+)'),
-        ('smartctl.value[%s,loadUnload]',      r'^Accumulated load-unload cycles:\s+(\d+)'),
-        ('smartctl.value[%s,loadUnloadMax]',   r'^Specified load-unload count over device lifetime:\s+(\d+)'),
-        ('smartctl.value[%s,startStop]',       r'^Accumulated start-stop cycles:\s+(\d+)|^Current start stop count:\s+(\d+)'),
-        ('smartctl.value[%s,startStopMax]',    r'^Recommended maximum start stop count:\s+(\d+)|^Specified cycle count over device lifetime:\s+(\d+)'),
-        ('smartctl.value[%s,defects]',         r'^Elements in grown defect list:\s+(\d+)'),
-        ('smartctl.value[%s,poweredHours]',    r'^number of hours powered up \=\s+(\d+)'),
-        ('smartctl.value[%s,nonMediumErrors]', r'^Non-medium error count:\s+(\d+)'),
+    if isinstance(p_, dict):
+        return findSmartSASJson(p_, diskIdent_)
+
+    keysAndLabelsSAS = (
+        ('smartctl.info[%s,revision]',         ('revision', 'version'), None),
+        ('smartctl.info[%s,compliance]',       ('compliance',), None),
+        ('smartctl.info[%s,manufacturedYear]', ('manufactured year',), None),
+        ('smartctl.value[%s,loadUnload]',      ('accumulated load-unload cycles',), NUMBER_RE),
+        ('smartctl.value[%s,loadUnloadMax]',   ('specified load-unload count over device lifetime',), NUMBER_RE),
+        ('smartctl.value[%s,startStop]',       ('accumulated start-stop cycles', 'current start stop count'), NUMBER_RE),
+        ('smartctl.value[%s,startStopMax]',    ('recommended maximum start stop count', 'specified cycle count over device lifetime'), NUMBER_RE),
+        ('smartctl.value[%s,defects]',         ('elements in grown defect list',), NUMBER_RE),
+        ('smartctl.value[%s,poweredHours]',    ('number of hours powered up',), None),
+        ('smartctl.value[%s,nonMediumErrors]', ('non-medium error count',), NUMBER_RE),
     )
     sender = []
     json = []
 
-    for key, regexp in keysAndRegexpsSAS:
-        valuesRaw = re.findall(regexp, p_, re.M | re.I)
-        value = findAny(valuesRaw)
+    for key, labels, pattern in keysAndLabelsSAS:
+        value = findLabel(p_, labels, pattern)
         if value:
-            sender.append('"%s" %s "%s"' % (HOST, (key % diskIdent_), sanitizeQuotes(value.strip())))
+            sender.append(((key % diskIdent_), value.strip()))
 
     if sender:
         json = [{'{#DISKIDSAS}':diskIdent_}]
@@ -309,23 +974,236 @@ def findSmartSAS(p_, diskIdent_):
 
 def whyNoSmart(p_):
 
-    messagesAndRegexps = (
-        ('SMART_UNAVAILABLE',     r'^SMART support is:\s+Unavailable - device lacks SMART capability'),
-        ('SMART_UNAVAILABLE_PID', r'^SMART support is:\s+Unavailable - Packet Interface Devices'),
-        ('SMART_DISABLED',        r'^SMART support is:\s+Disabled'),
-        ('SMART_UNK_USB_BRIDGE',  r'Unknown USB bridge'),
+    if isinstance(p_, dict):
+        return whyNoSmartJson(p_)
+
+    return p_.why
+
+
+def findJson(doc_, path_):
+    '''Walks nested dicts by dotted path. None if any step is missing.'''
+    value = doc_
+    for i in path_.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(i)
+
+    return value
+
+
+def findIdentJson(doc_, devName_):
+
+    ident = findJson(doc_, 'serial_number')
+
+    wwn = findJson(doc_, 'wwn')
+    if not ident and wwn:
+        try:
+            ident = '%x %06x %09x' % (wwn['naa'], wwn['oui'], wwn['id'])   # same as 'LU WWN Device Id'
+        except (KeyError, TypeError):
+            ident = None
+
+    if not ident:
+        ident = findJson(doc_, 'logical_unit_id')
+
+    if ident:
+        ident = sanitizeStr(str(ident))
+    else:
+        ident = devName_
+
+    return ident
+
+
+def findSataVersionJson(doc_):
+    '''Compose 'SATA Version is' line from its JSON parts.'''
+    version = findJson(doc_, 'sata_version.string')
+    speedMax = findJson(doc_, 'interface_speed.max.string')
+    speedCurrent = findJson(doc_, 'interface_speed.current.string')
+
+    if version and speedMax:
+        version = '%s, %s' % (version, speedMax)
+        if speedCurrent:
+            version = '%s (current: %s)' % (version, speedCurrent)
+
+    return version
+
+
+def findSpeedJson(doc_, path_):
+
+    speed = findJson(doc_, path_)
+    if speed:
+        speedRe = re.match(r'(\d+\.\d+)', speed)
+        if speedRe:
+            return speedRe.group(1)
+
+    return None
+
+
+def findSelftestJson(doc_):
+    '''Same wording as text output: PASSED/FAILED! for ATA and NVMe, OK/FAILED for SCSI.'''
+    passed = findJson(doc_, 'smart_status.passed')
+    if passed is None:
+        return None
+
+    if findJson(doc_, 'device.protocol') == 'SCSI':
+        return passed and 'OK' or 'FAILED'
+
+    return passed and 'PASSED' or 'FAILED!'
+
+
+def findSmartJson(doc_, diskIdent_):
+
+    rpm = findJson(doc_, 'rotation_rate')
+    if not rpm:   # 0 is reported for SSDs
+        rpm = None
+
+    keysAndValues = (
+        ('smartctl.info[%s,family]',           findJson(doc_, 'model_family')),
+        ('smartctl.info[%s,model]',            findJson(doc_, 'scsi_product') or findJson(doc_, 'model_name')),
+        ('smartctl.info[%s,selftest]',         findSelftestJson(doc_)),
+        ('smartctl.info[%s,serial]',           findJson(doc_, 'serial_number')),
+        ('smartctl.info[%s,sataVersion]',      findSataVersionJson(doc_)),
+        ('smartctl.info[%s,bandwidthMax]',     findSpeedJson(doc_, 'interface_speed.max.string')),
+        ('smartctl.info[%s,bandwidthCurrent]', findSpeedJson(doc_, 'interface_speed.current.string') or
+                                               findSpeedJson(doc_, 'interface_speed.max.string')),
+        ('smartctl.info[%s,rpm]',              rpm),
+        ('smartctl.info[%s,formFactor]',       findJson(doc_, 'form_factor.name')),
+        ('smartctl.info[%s,firmware]',         findJson(doc_, 'firmware_version')),
+        ('smartctl.info[%s,vendor]',           findJson(doc_, 'scsi_vendor') or findJson(doc_, 'vendor')),
+        ('smartctl.value[%s,SSDwear]',         findJson(doc_, 'scsi_percentage_used_endurance_indicator')),
+        ('smartctl.info[%s,capacity]',         findJson(doc_, 'user_capacity.bytes')),
+    )
+    sender = []
+    json = []
+
+    json.append({'{#DISKIDBANDWIDTH}':diskIdent_, '{#DISKIDSSD}':diskIdent_, '{#DISKID}':diskIdent_})   # one row, less LLD
+
+    for key, value in keysAndValues:
+        if value is not None and str(value) != '':
+            sender.append(((key % diskIdent_), str(value).strip()))
+
+    gotValues = False
+    table = findJson(doc_, 'ata_smart_attributes.table')
+    if table:
+        gotValues = True
+        sender.append(('smartctl.info[%s,SmartStatus]' % diskIdent_, 'SMART_SATA'))
+        for attribute in table:
+            rawRe = re.match(r'\d+', str(findJson(attribute, 'raw.string')))   # first number, as in text output
+            if not rawRe:
+                continue
+
+            sender.append(('smartctl.value[%s,%s]' % (diskIdent_, attribute['id']), rawRe.group(0)))
+            json.append({('{#DVALUE%s}' % attribute['id']):diskIdent_, '{#SMARTNAME}':attribute.get('name')})
+
+    return sender, json, gotValues
+
+
+def findSmartSASJson(doc_, diskIdent_):
+
+    sender = []
+    json = []
+
+    if findJson(doc_, 'device.protocol') != 'SCSI':
+        return sender, json
+
+    keysAndPaths = (
+        ('smartctl.info[%s,revision]',         'scsi_revision'),
+        ('smartctl.info[%s,compliance]',       'scsi_version'),
+        ('smartctl.info[%s,manufacturedYear]', 'scsi_start_stop_cycle_counter.year_of_manufacture'),
+        ('smartctl.value[%s,loadUnload]',      'scsi_start_stop_cycle_counter.accumulated_load_unload_cycles'),
+        ('smartctl.value[%s,loadUnloadMax]',   'scsi_start_stop_cycle_counter.specified_load_unload_count_over_device_lifetime'),
+        ('smartctl.value[%s,startStop]',       'scsi_start_stop_cycle_counter.accumulated_start_stop_cycles'),
+        ('smartctl.value[%s,startStopMax]',    'scsi_start_stop_cycle_counter.specified_cycle_count_over_device_lifetime'),
+        ('smartctl.value[%s,defects]',         'scsi_grown_defect_list'),
+        ('smartctl.value[%s,poweredHours]',    'power_on_time.hours'),
+        ('smartctl.value[%s,nonMediumErrors]', 'scsi_nonmedium_error.count'),
     )
 
+    for key, path in keysAndPaths:
+        value = findJson(doc_, path)
+        if value is not None and str(value) != '':
+            sender.append(((key % diskIdent_), str(value).strip()))
+
+    if sender:
+        json = [{'{#DISKIDSAS}':diskIdent_}]
+
+    return sender, json
+
+
+def whyNoSmartJson(doc_):
+
+    messages = findJson(doc_, 'smartctl.messages') or []
+    messages = ' '.join([ str(i.get('string')) for i in messages if isinstance(i, dict) ])
+
     msg = None
-    for m, regexp in messagesAndRegexps:
-        val = re.search(regexp, p_, re.M | re.I)
-        if val:
-            msg = m
-            break
+    if   findJson(doc_, 'smart_support.available') is False:
+        if 'Packet Interface' in messages:
+            msg = 'SMART_UNAVAILABLE_PID'
+        else:
+            msg = 'SMART_UNAVAILABLE'
+    elif findJson(doc_, 'smart_support.enabled') is False:
+        msg = 'SMART_DISABLED'
+    elif re.search(r'Unknown USB bridge', messages, re.I):
+        msg = 'SMART_UNK_USB_BRIDGE'
 
     return msg
 
 
+def runSmartctl(args_, timeout_=None):
+    '''smartctl output, raises like subprocess.check_output. Through the helper if it is running, with sudo otherwise.'''
+    if HELPER_SOCKET and os.path.exists(HELPER_SOCKET):
+        output = runHelper(args_, timeout_)
+        if output is not None:
+            return output
+
+    cmd = addSudoIfNix([BIN_PATH] + args_)
+    if timeout_ is None:
+        return subprocess.check_output(cmd, universal_newlines=True)
+
+    return subprocess.check_output(cmd, universal_newlines=True, timeout=timeout_)
+
+
+def runHelper(args_, timeout_):
+    '''One request to smartctl-helper.py. It runs smartctl as root with the same args.
+    None if the helper is not running.'''
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout((timeout_ or PER_DISK_TIMEOUT) + 5)
+
+    try:
+        sock.connect(HELPER_SOCKET)
+    except OSError:   # socket left by a stopped helper, or not in SOCKET_GROUP
+        sock.close()
+        return None
+
+    data = b''
+    try:
+        sock.sendall((dumps({'args': args_, 'timeout': timeout_}) + '\n').encode('utf-8'))
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        raise subprocess.TimeoutExpired(args_, timeout_)
+    finally:
+        sock.close()
+
+    try:
+        reply = loads(data.decode('utf-8'))
+    except ValueError:
+        raise OSError('Bad reply from helper')
+
+    if reply.get('timeout'):
+        raise subprocess.TimeoutExpired(args_, timeout_)
+    if 'error' in reply:
+        raise OSError(reply['error'])
+    if reply['returncode']:
+        raise subprocess.CalledProcessError(reply['returncode'], args_, output=reply['output'])
+
+    return reply['output']
+
+
 def addSudoIfNix(cmd):
 
     result = cmd
@@ -344,65 +1222,533 @@ def sanitizeQuotes(string):
     return string
 
 
-if __name__ == '__main__':
+def filterStatic(items_, diskState_):
+    '''Drop identity items that were already sent with the same value within STATIC_SEND_INTERVAL.
+    diskState_ is updated in place: key -> [value, last sent time].'''
+    now = time.time()
 
-    fail_ifNot_Py3()
+    result = []
+    for key, value in items_:
+        field = key.rsplit(',', 1)[-1].rstrip(']')
+        if field not in STATIC_FIELDS:
+            result.append((key, value))
+            continue
+
+        sent = diskState_.get(key)
+        if     (sent and
+                sent[0] == value and
+                now - sent[1] < STATIC_SEND_INTERVAL):
+
+            continue
+
+        diskState_[key] = [value, now]
+        result.append((key, value))
+
+    return result
+
+
+def filterUnchanged(items_, lastValues_, newValues_):
+    '''Drop items with the same value as in lastValues_. All values are recorded in newValues_.'''
+    result = []
+    for key, value in items_:
+        newValues_[key] = value
+        if lastValues_.get(key) != value:
+            result.append((key, value))
+
+    return result
+
+
+def filterSenderData(senderData_):
+    '''Apply STATIC_SEND_INTERVAL and IS_SEND_CHANGES_ONLY to disk items before sending. Host items are always sent.
+    Items are yielded as they come, state is saved after the last one.'''
+    if not STATIC_SEND_INTERVAL and not IS_SEND_CHANGES_ONLY:
+        for item in senderData_:
+            yield item
+        return
+
+    staticState = loadState('static')
+    staticStateNew = {}   # disks absent in this run are forgotten
+
+    changesState = {}
+    if IS_SEND_CHANGES_ONLY:
+        changesState = loadState('changes')
+    lastValues = changesState.get('values', {})
+    newValues = {}
+
+    heartbeat = changesState.get('heartbeat', 0)
+    if time.time() - heartbeat >= HEARTBEAT_INTERVAL:
+        heartbeat = time.time()
+        lastValues = {}   # send everything
+
+    for item in senderData_:
+        items = [item]
+
+        diskRe = DISK_KEY_RE.match(item[0])
+        if diskRe:
+            if STATIC_SEND_INTERVAL:
+                diskIdent = diskRe.group(1)   # device name in 'device' MODE, items of a moved disk are new for server
+                if diskIdent not in staticStateNew:
+                    staticStateNew[diskIdent] = staticState.get(diskIdent, {})
+                items = filterStatic(items, staticStateNew[diskIdent])
+
+            if IS_SEND_CHANGES_ONLY:
+                items = filterUnchanged(items, lastValues, newValues)
+
+        for i in items:
+            yield i
+
+    if STATIC_SEND_INTERVAL:
+        saveState('static', staticStateNew)
+
+    if IS_SEND_CHANGES_ONLY:
+        saveState('changes', {'heartbeat': heartbeat, 'values': newValues})
+
+
+def findDocument(senderData_, jsonData_):
+    '''Everything in one JSON document: LLD in 'data', item values by key in 'values', first one if repeated.'''
+    values = {}
+    for key, value in senderData_:
+        values.setdefault(key, value)
+
+    return {'time': int(time.time()), 'host': HOST, 'data': findLldRows(jsonData_), 'values': values}
+
+
+def formatSnapshot(senderData_, jsonData_):
+
+    return dumps(findDocument(senderData_, jsonData_), indent=4)
+
+
+def escapeLabel(string):
+
+    return string.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def formatTextfile(senderData_, jsonData_):
+    '''node_exporter textfile: numeric values as gauges like smartctl_value{disk="sda",item="5"}, text values as
+    a 'value' label of smartctl_info_text and the like, which are always 1.'''
+    metrics = {}   # name -> samples, lines of one metric must be together
+    seenKeys = set()   # one series per item, repeated ones are rejected by node_exporter
+    for key, value in senderData_:
+        keyRe = ITEM_KEY_RE.match(key)
+        if not keyRe or key in seenKeys:
+            continue
+        seenKeys.add(key)
+        params = keyRe.group(2).split(',')
+        if len(params) not in METRIC_LABELS:
+            continue
+
+        labels = [ '%s="%s"' % (name, escapeLabel(param)) for name, param in zip(METRIC_LABELS[len(params)], params) ]
+        value = str(value)
+        if NUMERIC_RE.match(value):
+            name = 'smartctl_' + keyRe.group(1)
+        else:
+            name = 'smartctl_%s_text' % keyRe.group(1)
+            labels.append('value="%s"' % escapeLabel(value))
+            value = '1'
+
+        metrics.setdefault(name, []).append('%s{%s} %s' % (name, ','.join(labels), value))
+
+    lines = []
+    for name, samples in metrics.items():
+        lines.append('# TYPE %s gauge' % name)
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def findSinks():
+    '''Enabled file outputs: (path, formatter of senderData and jsonData).'''
+    sinks = ((TEXTFILE_PATH, formatTextfile),
+             (SNAPSHOT_PATH, formatSnapshot))
+
+    return [ i for i in sinks if i[0] ]
+
+
+def writeSinks(senderData_, jsonData_):
+    '''Write all enabled file outputs, a failed one does not stop others or sending.'''
+    for path, formatter in findSinks():
+        try:
+            writeAtomic(path, formatter(senderData_, jsonData_))
+        except (IOError, OSError):
+            if sys.argv[1] == 'getverb':
+                print('Could not write output file:\n' + path)
+
+
+def iterSinks(chunks_):
+    '''Pass (senderData, jsonData) chunks through, file outputs are written after the last one.
+    Items are kept in memory only while file outputs are enabled.'''
+    if not findSinks():
+        for chunk in chunks_:
+            yield chunk
+        return
 
     senderData = []
     jsonData = []
+    for chunk in chunks_:
+        senderData.extend(chunk[0])
+        jsonData.extend(chunk[1])
+        yield chunk
+
+    writeSinks(senderData, findLldRows(jsonData))
+
+
+def formatSenderData(items_):
+    '''Compose zabbix sender input lines from (key, value) items.'''
+    return [ '"%s" %s "%s"' % (HOST, key, sanitizeQuotes(str(value))) for key, value in items_ ]
+
+
+def findDiskItems(p_, msg_, diskIdent_, devName_):
+    '''Sender items and LLD json of a queried disk.'''
+    diskItems = []
+    diskJson = []
+
+    diskItems.append(('smartctl.info[%s,DriveStatus]' % diskIdent_, msg_))
+    diskItems.append(('smartctl.info[%s,device]' % diskIdent_,      devName_))
+    findSmart_Out = findSmart(p_, diskIdent_)
+    diskSender = findSmart_Out[0]
+    gotSmart   = findSmart_Out[2]
+    if diskSender:
+        diskItems.extend(diskSender)
+        diskJson.extend(findSmart_Out[1])
+
+    if not gotSmart:
+        findSmartSAS_Out = findSmartSAS(p_, diskIdent_)
+        diskSenderSAS = findSmartSAS_Out[0]
+        if diskSenderSAS:
+            diskItems.append(('smartctl.info[%s,SmartStatus]' % diskIdent_, 'SMART_SAS'))
+            diskItems.extend(diskSenderSAS)
+            diskJson.extend(findSmartSAS_Out[1])
+        else:
+            diskItems.append(('smartctl.info[%s,SmartStatus]' % diskIdent_, str(whyNoSmart(p_))))
+
+    findTestStatus_Out = findTestStatus(p_)
+    if findTestStatus_Out[1] is not None:
+        diskItems.append(('smartctl.info[%s,selftestRemaining]' % diskIdent_, findTestStatus_Out[1]))
+    if findTestStatus_Out[2]:
+        diskItems.append(('smartctl.info[%s,selftestLast]' % diskIdent_,      findTestStatus_Out[2]))
+
+    return diskItems, diskJson
+
+
+def findPowerMode(p_):
+    '''Power mode of a disk that answered. Only text output of '-n' has it, the disk is awake otherwise.'''
+    if not isinstance(p_, dict):
+        mode = findLabel(p_, ('power mode is', 'power mode was'))
+        if mode:
+            return mode
+
+    return 'ACTIVE'
+
+
+def findQueryOptions(fullState_, stamp_):
+    '''smartctl options by disk, depending on its last full read.
+    Health only until FULL_POLL_INTERVAL passes, rotational disks are not woken up until STANDBY_MAX_STALENESS.
+    A full read is due when devices were added or removed since, another disk may be at the same path now.'''
+    options = {}
+    for devPath, cached in fullState_.items():
+        age = time.time() - cached.get('time', 0)
+        isSameDisk = cached.get('stamp') == stamp_
+
+        diskOptions = ['-a']
+        if     (FULL_POLL_INTERVAL and
+                age < FULL_POLL_INTERVAL and
+                isSameDisk):
+
+            diskOptions = ['-H', '-A']
+
+        isRotational = any([ i[0].endswith(',rpm]') for i in cached.get('items', []) ])
+        if     (IS_STANDBY_CHECK and
+                isRotational and
+                age < STANDBY_MAX_STALENESS and
+                isSameDisk):   # values of a replaced disk are not served while it sleeps
+
+            diskOptions.extend(['-n', 'standby'])
+
+        options[devPath] = diskOptions
+
+    return options
+
+
+def findTrendValues(diskItems_, diskIdent_):
+    '''Numbers of TREND_THRESHOLDS attributes from disk items.'''
+    items = dict(diskItems_)
+    values = {}
+    for i in TREND_THRESHOLDS:
+        try:
+            values[i] = float(items['smartctl.value[%s,%s]' % (diskIdent_, i)])
+        except (KeyError, ValueError):
+            pass
+
+    return values
+
+
+def updateTrend(trend_, values_, now_):
+    '''Ring buffer of one disk: 'times' and a list per attribute, aligned, at most TREND_SAMPLES long.'''
+    times = trend_.setdefault('times', [])
+    if times and now_ - times[-1] < TREND_SAMPLE_INTERVAL:
+        return
+
+    times.append(int(now_))
+    for i in TREND_THRESHOLDS:
+        if i in values_ or i in trend_:   # none kept for attributes the disk does not have
+            trend_.setdefault(i, [None] * (len(times) - 1)).append(values_.get(i))
+
+    for i in trend_:
+        del trend_[i][:-TREND_SAMPLES]
+
+
+def findTrends(trend_, values_, diskIdent_, now_):
+    '''Growth per day from the oldest kept value to current one, and days until threshold: 0 if reached,
+    -1 if not growing. Nothing until TREND_MIN_SPAN of history.'''
+    sender = []
+    json = []
+    for attribute, threshold in sorted(TREND_THRESHOLDS.items()):
+        current = values_.get(attribute)
+        if current is None:
+            continue
+
+        json.append({'{#DISKIDTREND}':diskIdent_, '{#TRENDATTR}':attribute})
+
+        oldest = [ i for i in zip(trend_.get('times', []), trend_.get(attribute, [])) if i[1] is not None ][:1]
+        if not oldest or now_ - oldest[0][0] < TREND_MIN_SPAN:
+            continue
+
+        rate = max(current - oldest[0][1], 0) / (now_ - oldest[0][0]) * 86400
+        if current >= threshold:
+            daysLeft = 0
+        elif rate:
+            daysLeft = (threshold - current) / rate
+        else:
+            daysLeft = -1
+
+        sender.append(('smartctl.trend[%s,%s,rate]' % (diskIdent_, attribute), '%.3f' % rate))
+        sender.append(('smartctl.trend[%s,%s,daysLeft]' % (diskIdent_, attribute), '%.1f' % daysLeft))
+
+    return sender, json
+
+
+def findTestType(record_, now_):
+    '''Self-test due on a disk by its record of last starts, long first. None if none is due.'''
+    if     (SELFTEST_LONG_INTERVAL and
+            now_ - record_.get('long', 0) >= SELFTEST_LONG_INTERVAL):
+
+        return 'long'
+
+    if     (SELFTEST_SHORT_INTERVAL and
+            now_ - max(record_.get('short', 0), record_.get('long', 0)) >= SELFTEST_SHORT_INTERVAL):   # long covers short
+
+        return 'short'
+
+    return None
+
+
+def isTestRunning(record_, cached_):
+    '''Self-test of a disk not fully read in this run, by its last full read: running then, or started since.'''
+    if not cached_:
+        return False
+
+    return bool(cached_.get('isTesting') or
+                max(record_.get('short', 0), record_.get('long', 0)) > cached_.get('time', 0))
+
+
+def scheduleTests(disks_, devPaths_, fullState_):
+    '''Start due self-tests, longest waiting first, while SELFTEST_PER_CONTROLLER and SELFTEST_MAX_RUNNING allow.
+    disks_ is [(devPath, isRunning)] of disks fully read in this run, only they are started. Running tests of other
+    devPaths_ are counted from their last full read in fullState_.'''
+    state = loadState('selftest')
+    stateNew = dict([ i for i in state.items() if i[0] in devPaths_ ])   # disks gone from scan are forgotten
+    now = time.time()
+
+    readNow = dict(disks_)
+    running = {}   # by controller, None for directly attached disks
+    due = []
+    for devPath in devPaths_:
+        record = stateNew.get(devPath, {})
+        if devPath in readNow:
+            isRunning = readNow[devPath]
+        else:
+            isRunning = isTestRunning(record, fullState_.get(devPath))
+
+        if isRunning:
+            controller = findController(devPath)
+            running[controller] = running.get(controller, 0) + 1
+            continue
+
+        testType = None
+        if devPath in readNow:
+            testType = findTestType(record, now)
+        if testType:
+            stateNew[devPath] = record
+            due.append((record.get(testType, 0), devPath, testType))
+
+    for lastStarted, devPath, testType in sorted(due):
+        if sum(running.values()) >= SELFTEST_MAX_RUNNING:
+            break
+
+        controller = findController(devPath)
+        if running.get(controller, 0) >= SELFTEST_PER_CONTROLLER:
+            continue
+
+        try:
+            runSmartctl(['-t', testType] + shlex.split(devPath), PER_DISK_TIMEOUT)
+        except subprocess.CalledProcessError:
+            stateNew[devPath][testType] = now   # not supported or refused, try again next interval
+            continue
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+
+        stateNew[devPath][testType] = now
+        running[controller] = running.get(controller, 0) + 1
+
+    saveState('selftest', stateNew)
+
+
+def mergeItems(cached_, diskItems_, diskJson_):
+    '''Fresh health items on top of the last full read.'''
+    fresh = dict(diskItems_)
+    diskItems = [ (key, fresh.pop(key, value)) for key, value in cached_['items'] ]
+    diskItems.extend([ i for i in diskItems_ if i[0] in fresh ])
+
+    diskJson = list(cached_['json'])
+    diskJson.extend([ i for i in diskJson_ if i not in diskJson ])
+
+    return diskItems, diskJson
+
+
+def iterCollect():
+    '''Query all disks and compose data for zabbix sender and LLD. Yields (senderData, jsonData) of every disk
+    as soon as it is done, host items last.'''
+    runStarted = time.time()
 
     listDisks_Out = listDisks()
     scanErrors = listDisks_Out[0]
     diskDevs   = listDisks_Out[1]
+    scanTime = time.time() - runStarted
 
     fatalError = None
-    allDiskIdents = []
+    allDiskIdents = set()
+
+    aliases = {}
+    if IS_SKIP_DUPLICATES:
+        aliases = findAliases(diskDevs)
+    identsNew = {}   # for findAliases() of the next run
+
+    fullState = {}   # last full read of every disk
+    if IS_STANDBY_CHECK or FULL_POLL_INTERVAL:
+        fullState = loadState('full')
+    fullStateNew = {}
+    hotplugStamp = findHotplugStamp()
+    queryOptions = findQueryOptions(fullState, hotplugStamp)
+
+    trendState = {}
+    if TREND_THRESHOLDS:
+        trendState = loadState('trends')
+    trendStateNew = {}   # disks absent in this run are forgotten
+
+    testDisks = []   # for scheduleTests()
+
+    diskOuts = collectDisks([ i for i in diskDevs if i not in aliases ], isJsonCapable(), queryOptions)
+
+    queryTime = 0
+    parseTime = 0
     for devPath in diskDevs:
+        if devPath in aliases:   # reported as the duplicate of the disk read under primary path
+            diskIdent = sanitizeStr(clearDiskTypeStr(devPath))   # fallback like findIdent() has
+            if aliases[devPath] in identsNew:   # primary is identified in this run
+                identsNew[devPath] = identsNew[aliases[devPath]]
+                if MODE != 'device':   # items of the primary, its status is not overwritten
+                    yield [], [{'{#DDRIVESTATUS}':identsNew[devPath]}]
+                    continue
+
+            yield [('smartctl.info[%s,DriveStatus]' % diskIdent, 'DUPLICATE')], [{'{#DDRIVESTATUS}':diskIdent}]
+            continue
+
+        queryStarted = time.time()
+        findProc_Out = next(diskOuts)
+        queryTime += time.time() - queryStarted
+
+        parseStarted = time.time()
         devName = sanitizeStr(clearDiskTypeStr(devPath))
-        findProc_Out = findProcOut(devPath)
         disk_msg  = findProc_Out[0]
         disk_pOut = findProc_Out[1]
+        disk_execTime  = findProc_Out[2]
+        disk_parseTime = findProc_Out[3]
 
         diskIdent = findIdent(disk_pOut, devName)
+
+        cached = None
+        if queryOptions.get(devPath, ['-a'])[0] != '-a' or disk_msg in ('STANDBY', 'SLEEP'):   # not a full read
+            cached = fullState[devPath]
+            fullStateNew[devPath] = cached
+            diskIdent = cached['ident']
+
         diskIdentDup = diskIdent
+        if diskIdentDup != devName:   # not a fallback
+            identsNew[devPath] = diskIdentDup
 
         if MODE == 'device':
             diskIdent = devName
 
-        jsonData.append({'{#DDRIVESTATUS}':diskIdent})
+        jsonData = [{'{#DDRIVESTATUS}':diskIdent}]
         if   disk_msg.startswith('FATAL_'):  # if scan was bypassed
             fatalError = disk_msg
+            yield [], jsonData
             break
         elif disk_msg.startswith('DISKFATAL_'):
-            senderData.append('"%s" smartctl.info[%s,DriveStatus] "%s"' % (HOST, diskIdent, disk_msg))
+            yield [('smartctl.info[%s,DriveStatus]' % diskIdent, disk_msg),
+                   ('smartctl.info[%s,QueryTime]' % diskIdent,   '%.3f' % disk_execTime)], jsonData
             continue
 
         if IS_SKIP_DUPLICATES:
             if diskIdentDup in allDiskIdents:
-                senderData.append('"%s" smartctl.info[%s,DriveStatus] "DUPLICATE"' % (HOST, diskIdent))
+                if MODE != 'device':   # same item as the first path, its status is not overwritten
+                    yield [], jsonData
+                else:
+                    yield [('smartctl.info[%s,DriveStatus]' % diskIdent, 'DUPLICATE')], jsonData
                 continue
-            allDiskIdents.append(diskIdentDup)
-
-        senderData.append('"%s" smartctl.info[%s,DriveStatus] "%s"' % (HOST, diskIdent, disk_msg))
-        senderData.append('"%s" smartctl.info[%s,device] "%s"'      % (HOST, diskIdent, devName))
-        findSmart_Out = findSmart(disk_pOut, diskIdent)
-        diskSender = findSmart_Out[0]
-        diskJson   = findSmart_Out[1]
-        gotSmart   = findSmart_Out[2]
-        if diskSender:
-            senderData.extend(diskSender)
-            jsonData.extend(diskJson)
+            allDiskIdents.add(diskIdentDup)
+
+        if disk_msg in ('STANDBY', 'SLEEP'):
+            diskItems = [ tuple(i) for i in cached['items'] ]
+            diskJson = cached['json']
+            powerMode = disk_msg
+        else:
+            diskItems, diskJson = findDiskItems(disk_pOut, disk_msg, diskIdent, devName)
+            powerMode = findPowerMode(disk_pOut)
+
+            isTesting = None
+            if not cached:   # full read, self-test state is known
+                isTesting = findTestStatus(disk_pOut)[0]
+                testDisks.append((devPath, isTesting))
+
+            if cached:
+                diskItems, diskJson = mergeItems(cached, diskItems, diskJson)
+            elif IS_STANDBY_CHECK or FULL_POLL_INTERVAL:
+                fullStateNew[devPath] = {'time': time.time(), 'ident': diskIdentDup, 'items': list(diskItems), 'json': diskJson,
+                                         'isTesting': isTesting, 'stamp': hotplugStamp}
+
+        if TREND_THRESHOLDS:
+            trendValues = findTrendValues(diskItems, diskIdent)
+            trendStateNew[diskIdentDup] = trendState.get(diskIdentDup, {})
+            if disk_msg not in ('STANDBY', 'SLEEP'):   # cached values are not new samples
+                updateTrend(trendStateNew[diskIdentDup], trendValues, time.time())
 
-        if not gotSmart:
-            findSmartSAS_Out = findSmartSAS(disk_pOut, diskIdent)
-            diskSenderSAS = findSmartSAS_Out[0]
-            diskJsonSAS   = findSmartSAS_Out[1]
-            if diskSenderSAS:
-                senderData.append('"%s" smartctl.info[%s,SmartStatus] "SMART_SAS"' % (HOST, diskIdent))
-                senderData.extend(diskSenderSAS)
-                jsonData.extend(diskJsonSAS)
-            else:
-                senderData.append('"%s" smartctl.info[%s,SmartStatus] "%s"' % (HOST, diskIdent, str(whyNoSmart(disk_pOut))))
+            trendItems, trendJson = findTrends(trendStateNew[diskIdentDup], trendValues, diskIdent, time.time())
+            diskItems = diskItems + trendItems
+            diskJson = diskJson + trendJson
+
+        jsonData.extend(diskJson)
+
+        diskItems.append(('smartctl.info[%s,QueryTime]' % diskIdent, '%.3f' % disk_execTime))
+        if IS_STANDBY_CHECK:
+            diskItems.append(('smartctl.info[%s,powerMode]' % diskIdent, powerMode))
+
+        parseTime += disk_parseTime + time.time() - parseStarted
+
+        yield diskItems, jsonData
+
+    for i in diskOuts:   # remaining disks after fatal error, latency is saved when all are done
+        pass
 
     if fatalError:
         configStatus = fatalError
@@ -411,8 +1757,257 @@ if __name__ == '__main__':
     else:
         configStatus = "CONFIGURED"
 
-    senderData.append('"%s" smartctl.info[ConfigStatus] "%s"' % (HOST, configStatus))
+    if IS_STANDBY_CHECK or FULL_POLL_INTERVAL:
+        saveState('full', fullStateNew)
+
+    if IS_SKIP_DUPLICATES:
+        saveState('idents', {'stamp': findHotplugStamp(), 'idents': identsNew})
+
+    if TREND_THRESHOLDS:
+        saveState('trends', trendStateNew)
+
+    if SELFTEST_SHORT_INTERVAL or SELFTEST_LONG_INTERVAL:
+        lastFullReads = dict(fullState)   # of disks that failed in this run too
+        lastFullReads.update(fullStateNew)
+        scheduleTests(testDisks, diskDevs, lastFullReads)
+
+    yield [('smartctl.info[ConfigStatus]', configStatus),
+           ('smartctl.info[ScanTime]',  '%.3f' % scanTime),
+           ('smartctl.info[QueryTime]', '%.3f' % queryTime),
+           ('smartctl.info[ParseTime]', '%.3f' % parseTime),
+           ('smartctl.info[RunTime]',   '%.3f' % (time.time() - runStarted))], []
+
+
+def collectAll():
+    '''Data of iterCollect() joined into (senderData, jsonData).'''
+    senderData = []
+    jsonData = []
+    for diskItems, diskJson in iterSinks(iterCollect()):
+        senderData.extend(diskItems)
+        jsonData.extend(diskJson)
+
+    return senderData, jsonData
+
+
+def streamData(chunks_, isLld_=True):
+    '''get and send modes: pass items of every disk to the sender as soon as they are ready, then print LLD,
+    or only its hash if not isLld_. Only the LLD is kept in memory.'''
+    senderProc = openSender(AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, SEND_DEADLINE, HOST,
+                            sendTimeKey_='smartctl.info[SendTime]', isFork_=IS_FORK_SENDER)
+
+    jsonData = []
+    def iterItems():
+        for diskItems, diskJson in chunks_:
+            jsonData.extend(diskJson)
+            for i in diskItems:
+                yield i
+
+    payloadSize = -1   # no newline after the last line
+    for item in filterSenderData(iterItems()):
+        line = formatSenderData([item])[0]
+        payloadSize += len(line.encode('utf-8')) + 1
+        if senderProc:
+            try:
+                senderProc.stdin.write(line + '\n')
+            except OSError:   # sender is gone, LLD is still needed
+                senderProc = None
+
+    jsonData = findLldRows(jsonData)
+    lldHash = findLldHash(jsonData)
+
+    # in send mode server does not get LLD now, resending would not help items of new disks
+    trailer = formatSenderData([('smartctl.info[PayloadSize]', max(payloadSize, 0))])
+    isChanged = isLld_ and isLldChanged(lldHash)
+    if not isChanged:
+        trailer.append('deadline 0')   # nothing to wait for, send once
+
+    if senderProc:
+        try:
+            passData(senderProc, '\n'.join(trailer) + '\n')
+        except OSError:
+            pass
+
+    if isLld_:
+        print(dumps({'data': jsonData}, separators=(',', ':')))
+        sys.stdout.flush()   # agent got it, otherwise next run resends too
+        if isChanged:
+            saveState('lld', {'hash': lldHash})
+    else:
+        print(lldHash)
+
+
+def printTimings(senderData_, payloadSize_):
+    '''Collector self-monitoring summary for getverb.'''
+    values = dict(senderData_)
+
+    print('  Timings, seconds:')
+    for i in ('ScanTime', 'QueryTime', 'ParseTime', 'RunTime'):
+        print('%-10s %s' % (i, values.get('smartctl.info[%s]' % i)))
+    print('%-10s %s bytes' % ('Payload', payloadSize_))
+
+    diskTimes = [ (float(value), key) for key, value in senderData_
+                  if key.endswith(',QueryTime]') ]
+    if diskTimes:
+        print('  Slowest disks:')
+        for value, key in sorted(diskTimes, reverse=True)[:5]:
+            print('%-10s %.3f' % (key[len('smartctl.info['):-len(',QueryTime]')], value))
+
+    print()
 
-    link = r'https://github.com/nobody43/zabbix-smartmontools/issues'
-    processData(senderData, jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, DELAY, HOST, link)
 
+def loadState(name_):
+    '''Read JSON state from STATE_DIR. Empty if absent or unreadable.'''
+    try:
+        with open(os.path.join(STATE_DIR, name_ + '.json')) as f:
+            state = loads(f.read())
+    except (IOError, OSError, ValueError):
+        state = {}
+
+    if not isinstance(state, dict):
+        state = {}
+
+    return state
+
+
+def writeAtomic(path_, text_):
+    '''Write through a temporary file in the same directory, readers never see a partial file. Python33 or above required.'''
+    dirPath = os.path.dirname(path_)
+    if dirPath and not os.path.isdir(dirPath):
+        os.makedirs(dirPath)
+
+    tmpPath = '%s.%s.tmp' % (path_, os.getpid())
+    with open(tmpPath, 'w') as f:
+        f.write(text_)
+
+    os.replace(tmpPath, path_)
+
+
+def saveState(name_, state_):
+    '''Atomically write JSON state to STATE_DIR.'''
+    path = os.path.join(STATE_DIR, name_ + '.json')
+    try:
+        writeAtomic(path, dumps(state_))
+
+    except (IOError, OSError, AttributeError):
+        if sys.argv[1] == 'getverb':
+            print('Could not write state file:\n' + path)
+
+
+def loadDaemonResults():
+    '''Latest results of the daemon for this host, or None if there are no fresh ones.'''
+    state = loadState('daemon')
+    if     (state.get('host') == HOST and
+            time.time() - state.get('time', 0) < DAEMON_MAX_AGE):
+
+        senderData = [ tuple(i) for i in state.get('senderData', []) ]
+
+        return senderData, state.get('jsonData', [])
+
+    return None
+
+
+def findLldRows(jsonData_):
+    '''LLD without repeated rows, in order of appearance.'''
+    rows = []
+    seen = set()
+    for i in jsonData_:
+        row = tuple(sorted(i.items()))
+        if row not in seen:
+            seen.add(row)
+            rows.append(i)
+
+    return rows
+
+
+def findLldHash(jsonData_):
+
+    return '%08x' % (zlib.crc32(dumps(jsonData_, sort_keys=True).encode('utf-8')) & 0xffffffff)   # hashlib is slow to import
+
+
+def isLldChanged(lldHash_):
+    '''Compare LLD with the last one printed. Server has all the items if it is the same.'''
+    return loadState('lld').get('hash') != lldHash_
+
+
+def serveHttp(latest_):
+    '''Serve latest_['document'] to any GET request, for HTTP agent items.'''
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            document = latest_.get('document')
+            if document is None:
+                self.send_error(503, 'No results yet')
+                return
+
+            body = dumps(document).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((DAEMON_HTTP_ADDRESS, DAEMON_HTTP_PORT), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def runDaemon():
+    '''Poll disks every DAEMON_INTERVAL and keep the latest results in state file.'''
+    latest = {}
+    if DAEMON_HTTP_PORT:
+        serveHttp(latest)
+
+    while True:
+        started = time.time()
+
+        senderData, jsonData = collectAll()
+        saveState('daemon', {'time': time.time(), 'host': HOST, 'senderData': senderData, 'jsonData': jsonData})
+        latest['document'] = findDocument(senderData, jsonData)
+
+        time.sleep(max(0, DAEMON_INTERVAL - (time.time() - started)))
+
+
+if __name__ == '__main__':
+
+    fail_ifNot_Py3()
+
+    if sys.argv[1] == 'daemon':
+        runDaemon()
+
+    daemonResults = loadDaemonResults()
+    if sys.argv[1] in ('get', 'send'):   # 'send' is for values between discoveries, prints only LLD hash
+        if daemonResults:
+            streamData([daemonResults], sys.argv[1] == 'get')
+        else:
+            streamData(iterSinks(iterCollect()), sys.argv[1] == 'get')
+        sys.exit(0)
+
+    if daemonResults:
+        senderData, jsonData = daemonResults
+        if sys.argv[1] == 'getverb':
+            print('  Using results of the running daemon.\n')
+    else:
+        senderData, jsonData = collectAll()
+
+    if sys.argv[1] == 'getall':   # for dependent items, nothing is sent
+        print(formatSnapshot(senderData, jsonData))
+        sys.exit(0)
+
+    senderData = list(filterSenderData(senderData))
+
+    senderLines = formatSenderData(senderData)
+    payloadSize = len('\n'.join(senderLines).encode('utf-8'))
+    senderLines.extend(formatSenderData([('smartctl.info[PayloadSize]', payloadSize)]))
+
+    if sys.argv[1] == 'getverb':
+        printTimings(senderData, payloadSize)
+
+    link = r'https://github.com/nobody43/zabbix-smartmontools/issues'
+    processData(senderLines, jsonData, AGENT_CONF_PATH, SENDER_WRAPPER_PATH, SENDER_PATH, SEND_DEADLINE, HOST, link,
+                sendTimeKey_='smartctl.info[SendTime]')